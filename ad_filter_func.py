@@ -1,6 +1,7 @@
 import os
 import re
 from collections import Counter
+from urllib.parse import urljoin, urlparse
 
 
 def ads_detect_analyze_ts_pattern(ts_list):
@@ -77,36 +78,16 @@ def ads_detect_by_sequence(ts_list):
     return ad_indices
 
 
-def ads_detect_by_duration(ts_list, m3u8_path):
-    """analyze the AD based on duration (reading EXTINF tag form m3u8 file)"""
+def ads_detect_by_duration(table):
+    """analyze the AD based on duration (EXTINF column of the parsed segment table)"""
     ad_indices = []
-    durations = []
-
-    # Read the m3u8 file to get the duration of each segment
-    with open(m3u8_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    current_duration = None
-    ts_index = 0
-
-    for line in lines:
-        line = line.strip()
-        # analyze #EXTINF tag
-        if line.startswith('#EXTINF:'):
-            match = re.search(r'#EXTINF:([\d.]+)', line)
-            if match:
-                current_duration = float(match.group(1))
-        # encounter ts file
-        elif line and not line.startswith('#'):
-            if current_duration is not None:
-                durations.append((ts_index, current_duration))
-            ts_index += 1
-            current_duration = None
+    # Segments without EXTINF tag are -1 and don't take part
+    durations = [(i, d) for i, d in enumerate(table.durations) if d >= 0]
 
     if len(durations) < 10:
         return ad_indices
 
-        # Analyze duration distribution
+    # Analyze duration distribution
     duration_values = [d for _, d in durations]
     duration_counter = Counter([round(d, 1) for d in duration_values])
 
@@ -123,21 +104,24 @@ def ads_detect_by_duration(ts_list, m3u8_path):
     return ad_indices
 
 
-def ads_detect_by_filesize(ts_list):
+def ads_detect_by_filesize(ts_list, ts_dir="./m3u8"):
     """Analyze the AD base on file size"""
-    ad_indices = []
     sizes = []
 
     for i, entry in enumerate(ts_list):
-        # Built file path
-        candidate = entry
-        if not os.path.isabs(candidate) and not candidate.startswith("http"):
-            candidate = os.path.join("./m3u8", os.path.basename(entry))
+        # Built file path, segments are saved flat in ts_dir
+        candidate = os.path.join(ts_dir, os.path.basename(urlparse(entry).path))
 
         if os.path.exists(candidate):
             size = os.path.getsize(candidate)
             sizes.append((i, size))
 
+    return ads_detect_by_sizes(sizes)
+
+
+def ads_detect_by_sizes(sizes):
+    """Analyze the AD base on (index, byte size) pairs, the sizes may come from files or from Content-Length"""
+    ad_indices = []
     if len(sizes) < 10:
         return ad_indices
 
@@ -155,3 +139,91 @@ def ads_detect_by_filesize(ts_list):
             ad_indices.append(idx)
 
     return ad_indices
+
+
+def ads_detect_by_discontinuity(table, max_ad_seconds=120):
+    """
+    Analyze the AD based on #EXT-X-DISCONTINUITY blocks (playlist only)
+    An inserted AD is a short block between discontinuities, shorter than the blocks around it
+"""
+    ad_indices = []
+    starts = [0] + [i for i in range(1, len(table)) if table.discontinuity[i]]
+    if len(starts) < 2:
+        return ad_indices
+
+    bounds = starts + [len(table)]
+    blocks = [(a, b, sum(d for d in table.durations[a:b] if d >= 0)) for a, b in zip(bounds, bounds[1:])]
+    total = sum(duration for _, _, duration in blocks)
+    for k, (a, b, duration) in enumerate(blocks):
+        neighbours = [blocks[j][2] for j in (k - 1, k + 1) if 0 <= j < len(blocks)]
+        if duration <= max_ad_seconds and duration < total * 0.25 and all(n > duration for n in neighbours):
+            ad_indices.extend(range(a, b))
+    return ad_indices
+
+
+def ads_detect_by_url_prefix(ts_list, head_url=""):
+    """Analyze the AD based on the segment folder, inserted ADs are usually served from another path or host"""
+    ad_indices = []
+    prefixes = [urljoin(head_url or "", entry).rsplit("/", 1)[0] for entry in ts_list]
+    if len(prefixes) < 10:
+        return ad_indices
+
+    main_prefix, count = Counter(prefixes).most_common(1)[0]
+    # Only trust it when one folder clearly holds the episode
+    if count >= len(prefixes) * 0.8:
+        ad_indices = [i for i, prefix in enumerate(prefixes) if prefix != main_prefix]
+    return ad_indices
+
+
+def ads_detect_by_packets(features, max_ad_seconds=180, tolerance_seconds=1.0, max_layout_runs=4):
+    """
+    Analyze the AD based on MPEG-TS packet features (one ts_packet_func.analyze_ts_file result per segment)
+      - stream layout: a short contiguous run of segments whose PID set differs from the majority comes from
+        another muxer, odd layouts scattered over the episode (more than max_layout_runs runs) belong to it
+      - spliced timeline: a short run between two PTS jumps, where the segment before the run and the
+        segment after it continue each other's timeline, was inserted into the episode
+"""
+    ad_indices = set()
+    valid = [(i, f) for i, f in enumerate(features) if f]
+    if len(valid) < 10:
+        return []
+
+    wrap = 1 << 33
+    tolerance = tolerance_seconds * 90000
+
+    def gap(a, b):
+        return ((b - a + wrap // 2) % wrap) - wrap // 2
+
+    # Strategy1: PID layout differs from the main content
+    layout_counter = Counter(f['pids'] for _, f in valid)
+    main_layout, main_count = layout_counter.most_common(1)[0]
+    if main_count >= len(valid) * 0.5:
+        runs = []
+        for i, f in valid:
+            if f['pids'] == main_layout:
+                continue
+            if runs and runs[-1][-1] == i - 1:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        if len(runs) <= max_layout_runs:
+            for run in runs:
+                seconds = sum(gap(features[i]['pts_start'], features[i]['pts_end']) / 90000
+                              for i in run if features[i]['pts_start'] is not None)
+                if len(run) <= len(valid) * 0.25 and seconds <= max_ad_seconds:
+                    ad_indices.update(run)
+
+    # Strategy2: inserted timeline
+    timed = [(i, f) for i, f in valid if f['pts_start'] is not None]
+    breaks = [j for j in range(1, len(timed))
+              if abs(gap(timed[j - 1][1]['pts_end'], timed[j][1]['pts_start'])) > tolerance]
+    bounds = [0] + breaks + [len(timed)]
+    for start, end in zip(bounds, bounds[1:]):
+        if start == 0 or end == len(timed):
+            continue  # the run must be surrounded by content on both sides
+        resumed = abs(gap(timed[start - 1][1]['pts_end'], timed[end][1]['pts_start'])) <= tolerance
+        length = gap(timed[start][1]['pts_start'], timed[end - 1][1]['pts_end']) / 90000
+        if resumed and 0 <= length <= max_ad_seconds:
+            ad_indices.update(i for i, _ in timed[start:end])
+
+    return sorted(ad_indices)
@@ -0,0 +1,84 @@
+import hashlib
+import os
+from urllib.parse import urljoin, urlparse
+
+import state_store
+
+HEAD_HASH_BYTES = 64 * 1024  # enough to tell two segments apart, cheap to read again at merge time
+MIN_EPISODES_TO_SKIP = 2  # an AD must be confirmed in this many episodes before it is no longer downloaded
+
+
+def ad_url_key(url: str):
+    """host + path, the query usually carries a per-request token"""
+    parsed = urlparse(url)
+    return parsed.netloc + parsed.path
+
+
+def head_hash(path: str, offset: int = 0, size: int = HEAD_HASH_BYTES):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        digest.update(f.read(min(size, HEAD_HASH_BYTES)))
+    return digest.hexdigest()
+
+
+def _locate(table, ts_dir: str, located: dict | None):
+    """{index: (path, offset, size)} of the segments on disk, located is given for a direct output"""
+    if located is not None:
+        return located
+    found = {}
+    for i, entry in enumerate(table.uris):
+        path = os.path.join(ts_dir, os.path.basename(urlparse(entry).path))
+        try:
+            found[i] = (path, 0, os.path.getsize(path))
+        except OSError:
+            continue
+    return found
+
+
+def _duration_key(duration):
+    return round(duration, 1) if duration >= 0 else None
+
+
+def _segment_url(head_url, entry):
+    return entry if entry.startswith(("http://", "https://")) else urljoin(head_url or "", entry)
+
+
+def known_ads_by_url(head_url: str, table, min_episodes: int = MIN_EPISODES_TO_SKIP):
+    """Indices of the playlist entries matching a confirmed AD by URL and EXTINF, known before any download"""
+    known = state_store.get_ad_urls(min_episodes)
+    if not known:
+        return set()
+    return {i for i, entry in enumerate(table.uris)
+            if (ad_url_key(_segment_url(head_url, entry)), _duration_key(table.durations[i])) in known}
+
+
+def known_ads_by_content(table, ts_dir: str, located: dict | None = None):
+    """
+    Indices of the downloaded segments whose size and first bytes match a confirmed AD
+    :param located: {index: (path, offset, size)} when the segments live inside the direct output
+"""
+    contents = state_store.get_ad_contents()
+    if not contents:
+        return set()
+    found = set()
+    for i, (path, offset, size) in _locate(table, ts_dir, located).items():
+        # Only the segments with the size of a known AD are hashed
+        if size in contents and head_hash(path, offset, size) in contents[size]:
+            found.add(i)
+    return found
+
+
+def remember_ads(head_url: str, table, ad_indices, ts_dir: str, located: dict | None = None):
+    """Store the fingerprints of the AD segments confirmed for this episode"""
+    located = _locate(table, ts_dir, located)
+    rows = []
+    for i in sorted(ad_indices):
+        if i not in located:
+            continue  # skipped before download, its fingerprint is already known
+        path, offset, size = located[i]
+        rows.append((size, head_hash(path, offset, size), ad_url_key(_segment_url(head_url, table.uris[i])),
+                     _duration_key(table.durations[i])))
+    if rows:
+        state_store.save_ad_fingerprints(ts_dir, rows)
+    return len(rows)
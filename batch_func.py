@@ -0,0 +1,88 @@
+import json
+
+DEGRADED_ERROR_RATE = 0.5  # a source failing more of its probe segments than this is only a fallback
+
+
+def split_episode_ranges(spec: str):
+    """
+    Episode ranges of a job, 1-based and inclusive like the interactive prompt: '1-12,15,20-' ('' means all)
+    :return: [(first, last or None for open ranges)], raises ValueError on a malformed spec
+"""
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        try:
+            start = int(first) if first.strip() else 1
+            end = (int(last) if last.strip() else None) if sep else start
+        except ValueError:
+            raise ValueError(f"[ERR] Invalid Episode Range: {part}") from None
+        if start < 1 or (end is not None and end < start):
+            raise ValueError(f"[ERR] Invalid Episode Range: {part}")
+        ranges.append((start, end))
+    return ranges
+
+
+def parse_episode_ranges(spec: str, count: int):
+    """
+    :param count: episodes of the chosen source, open ranges end there
+    :return: sorted 0-based episode indices
+"""
+    ranges = split_episode_ranges(spec)
+    if not ranges:
+        return list(range(count))
+    indices = set()
+    for start, end in ranges:
+        indices.update(range(start - 1, min(end or count, count)))
+    return sorted(indices)
+
+
+def source_score(probe: dict):
+    """Sample throughput in bytes/s, discounted by the share of failed sample segments"""
+    return (probe["throughput"] or 0.0) * (1 - probe["error_rate"])
+
+
+def rank_sources(probes: list, preferred=()):
+    """
+    Order the sources of a series, best first: the healthy ones, preferred names first in their order and the
+    rest by score (latency breaks ties), then the degraded ones, then the ones which couldn't be resolved
+    :param probes: main.probe_source results
+"""
+    preferred = list(preferred)
+
+    def key(probe):
+        if probe["throughput"] is None:
+            return 2, 0, 0.0, 0.0
+        rank = preferred.index(probe["name"]) if probe["name"] in preferred else len(preferred)
+        return (int(probe["error_rate"] > DEGRADED_ERROR_RATE), rank, -source_score(probe),
+                probe["latency"] if probe["latency"] is not None else float("inf"))
+
+    return sorted(probes, key=key)
+
+
+def describe_probe(probe: dict):
+    if probe["throughput"] is None:
+        return f"{probe['name']}: {len(probe['episodes'])} Episode(s), Unreachable"
+    latency = f"{probe['latency'] * 1000:.0f} ms" if probe["latency"] is not None else "-"
+    return (f"{probe['name']}: {len(probe['episodes'])} Episode(s), {probe['throughput'] / 1024 / 1024:.1f} MB/s, "
+            f"First Byte {latency}, {probe['error_rate']:.0%} Errors")
+
+
+def load_job_file(path: str, sources=(), episodes: str = ""):
+    """
+    Jobs from a JSON file, a list of {"url": ..., "sources": [...], "episodes": "1-12"}
+    sources and episodes are optional, the given defaults apply to the entries without them
+    :return: [(url, sources, episodes)]
+"""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    jobs = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        spec = str(entry.get("episodes", episodes))
+        split_episode_ranges(spec)  # reject a bad range now, not in the worker
+        jobs.append((entry["url"], list(entry.get("sources", sources)), spec))
+    return jobs
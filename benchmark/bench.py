@@ -0,0 +1,284 @@
+"""
+Benchmark of the download / detect / merge pipeline against the local stand-in site
+
+    python -m benchmark.bench                    run every scenario, compare with baselines.json
+    python -m benchmark.bench -s clean lossy     run some of them
+    python -m benchmark.bench --save             store the results as the new baselines
+    python -m benchmark.hls_server --latency 0.05  serve the stand-in site alone, for manual runs of main.py
+
+Every scenario runs in its own process from an empty temporary folder, so peak RSS, the state store
+and the tuned host limits belong to that scenario alone.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from benchmark.hls_server import StandInOptions, StandInServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+REGRESSION_TOLERANCE = 0.25  # relative change tolerated before a metric counts as a regression
+REPEAT = 3  # runs of every scenario, the median of each metric is reported
+
+SCENARIOS = {
+    "clean": StandInOptions(episodes=2, segments=120, latency=0.01),
+    "lossy": StandInOptions(episodes=2, segments=120, latency=0.01, error_rate=0.05),
+    "throttled": StandInOptions(episodes=1, segments=60, latency=0.08, bandwidth=1024 * 1024),
+    "sequential": StandInOptions(episodes=2, segments=120, latency=0.01, naming="sequential"),
+    "long": StandInOptions(episodes=1, segments=600, ad_blocks=(100, 300, 500)),
+    "tail": StandInOptions(episodes=2, segments=200, latency=0.01, slow_rate=0.03, slow_latency=2.0),
+    "encrypted": StandInOptions(episodes=2, segments=120, latency=0.01, encrypt=True),
+    "tail_direct": StandInOptions(episodes=2, segments=200, latency=0.01, bandwidth=512 * 1024, slow_rate=0.05,
+                                  slow_latency=0.4),
+}
+DIRECT_SCENARIOS = {"tail_direct"}  # written straight into the output (--no-cache), hedges share one position
+
+# direction of every reported metric: +1 higher is better, -1 lower is better
+METRICS = {
+    "scrape_s": -1,
+    "download_s": -1,
+    "segments_per_s": 1,
+    "download_mb_per_s": 1,
+    "latency_p50_ms": -1,
+    "latency_p99_ms": -1,
+    "detect_s": -1,
+    "merge_mb_per_s": 1,
+    "peak_rss_mb": -1,
+    "plan_precision": 1,
+    "plan_recall": 1,
+    "detect_precision": 1,
+    "detect_recall": 1,
+}
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def precision_recall(found: set, truth: set):
+    """Both are 1.0 when nothing is found and there is nothing to find"""
+    hits = len(found & truth)
+    precision = hits / len(found) if found else float(not truth)
+    recall = hits / len(truth) if truth else 1.0
+    return precision, recall
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(options: StandInOptions, direct: bool = False):
+    """
+    Run the pipeline stage by stage in the current folder, return the metrics
+    :param direct: no-cache mode, the segments go into the output and the merge is its compaction
+"""
+    server = StandInServer(options).start()
+    # main.py reads the site from config.py, which is not part of the repository
+    sys.modules["config"] = types.SimpleNamespace(URL=server.series_url, HEADERS={"User-Agent": "bench"},
+                                                  Episode_URL=server.episode_url)
+    sys.path.insert(0, ROOT)
+    import aiohttp
+    import main
+    from http_func import run_async, POOL_LIMIT, POOL_LIMIT_PER_HOST
+    from m3u8_func import load_segment_table, segment_path
+    from direct_output_func import DirectOutput, compact_output
+    from merge_func import merge_segments
+    from plan_func import plan_download
+    from postprocess_func import detect_ad_segments
+
+    try:
+        start = time.perf_counter()
+        name = main.get_episode_list_url(server.series_url)
+        numbers, links = main.choice_video_source(name, 1)
+        playlists = []
+        for number, link in zip(numbers, links):
+            g_path = f"./m3u8/{name}/cache/{number}_bench/"
+            head_url, m3u8_url = main.get_episode_m3u8(link, g_path)
+            main.download_m3u8(m3u8_url, g_path)
+            playlists.append((g_path, head_url))
+        scrape_s = time.perf_counter() - start
+
+        latencies = []
+        downloaded = {"bytes": 0, "segments": 0}
+        outputs = {}  # episode number -> DirectOutput
+
+        async def download_all():
+            started = {}
+
+            async def on_request_start(session, context, params):
+                started.setdefault(params.url.path.rsplit("/", 1)[-1], time.perf_counter())
+
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(on_request_start)
+            connector = aiohttp.TCPConnector(limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST)
+            async with aiohttp.ClientSession(connector=connector, trace_configs=[trace]) as session:
+                for n, (g_path, head_url) in enumerate(playlists, start=1):
+                    def on_result(entry, result):
+                        # request start (first attempt) to the segment on disk
+                        began = started.pop(entry.rsplit("/", 1)[-1], None)
+                        if isinstance(result, int):
+                            downloaded["bytes"] += result
+                            downloaded["segments"] += 1
+                            if began is not None:
+                                latencies.append(time.perf_counter() - began)
+
+                    output = None
+                    if direct:
+                        table = load_segment_table(f"{g_path}file/video.m3u8")
+                        output = outputs[n] = DirectOutput(f"./m3u8/{name}/{n}.ts", table, resume=False)
+                        output.plan(await main.probe_segment_sizes(head_url, dict(enumerate(table.uris)), session))
+                    await main.download_video(head_url, path=f"{g_path}file/video.m3u8", pattern="M",
+                                              save_dir=g_path, session=session, on_result=on_result, output=output)
+
+        start = time.perf_counter()
+        run_async(download_all())
+        download_s = time.perf_counter() - start
+
+        plan_found, detect_found, truth = set(), set(), set()
+        detect_s = 0.0
+        merge_bytes, merge_s = 0, 0.0
+        for n, (g_path, head_url) in enumerate(playlists, start=1):
+            table = load_segment_table(f"{g_path}file/video.m3u8")
+            offset = n * 100000  # keep the indices of the episodes apart
+            truth |= {offset + i for i in server.ad_indices(n)}
+            plan_found |= {offset + i for i in plan_download(table, head_url)}
+
+            output_file = f"./m3u8/{name}/{n}.ts"
+            located = segments = sizes = None
+            if direct:
+                segments = outputs[n].detach()["segments"]
+                if len(segments) != len(table):
+                    raise RuntimeError(f"Episode {n}: {len(table) - len(segments)} Segment(s) Never Written")
+                located = {i: (output_file, at, size) for i, (at, size) in segments.items()}
+                sizes = sorted((i, size) for i, (_, size) in segments.items())
+
+            start = time.perf_counter()
+            ads = detect_ad_segments(table, g_path, head_url, sizes=sizes, located=located)
+            detect_s += time.perf_counter() - start
+            detect_found |= {offset + i for i in ads}
+
+            if direct:
+                written, elapsed, _ = compact_output(output_file, segments,
+                                                     [i for i in range(len(table)) if i not in ads])
+            else:
+                kept = [segment_path(g_path, entry) for i, entry in enumerate(table.uris) if i not in ads]
+                written, elapsed, _ = merge_segments(kept, output_file)
+            merge_bytes += written
+            merge_s += elapsed
+
+        plan_precision, plan_recall = precision_recall(plan_found, truth)
+        detect_precision, detect_recall = precision_recall(detect_found, truth)
+        return {
+            "scrape_s": scrape_s,
+            "download_s": download_s,
+            "segments_per_s": downloaded["segments"] / max(download_s, 1e-9),
+            "download_mb_per_s": downloaded["bytes"] / 1024 / 1024 / max(download_s, 1e-9),
+            "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+            "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            "detect_s": detect_s,
+            "merge_mb_per_s": merge_bytes / 1024 / 1024 / max(merge_s, 1e-9),
+            "peak_rss_mb": peak_rss_mb(),
+            "plan_precision": plan_precision,
+            "plan_recall": plan_recall,
+            "detect_precision": detect_precision,
+            "detect_recall": detect_recall,
+            "server_errors": server.hits["error"],
+        }
+    finally:
+        server.stop()
+
+
+def run_isolated(name: str, verbose: bool = False):
+    """Run one scenario in a child process from an empty folder, the pipeline's output is dropped unless verbose"""
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as work_dir:
+        result_path = os.path.join(work_dir, "result.json")
+        env = {**os.environ, "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+        proc = subprocess.run([sys.executable, "-m", "benchmark.bench", "--run-one", name, "--out", result_path],
+                              cwd=work_dir, env=env, stdout=None if verbose else subprocess.DEVNULL,
+                              stderr=None if verbose else subprocess.PIPE, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Scenario {name} failed:\n{proc.stderr or ''}")
+        with open(result_path, encoding="utf-8") as f:
+            return json.load(f)
+
+
+def run_repeated(name: str, repeat: int = REPEAT, verbose: bool = False):
+    """Median of every metric over several isolated runs, single runs swing too much on a busy machine"""
+    runs = [run_isolated(name, verbose) for _ in range(repeat)]
+    return {metric: percentile([run[metric] for run in runs], 0.5) for metric in runs[0]}
+
+
+def compare(results: dict, baselines: dict, tolerance: float = REGRESSION_TOLERANCE):
+    """Print every metric against its baseline, return the regressions"""
+    regressions = []
+    for scenario, metrics in results.items():
+        base = baselines.get(scenario, {})
+        print(f"\n== {scenario} ==")
+        for metric, direction in METRICS.items():
+            value = metrics[metric]
+            old = base.get(metric)
+            if not old:
+                print(f"  {metric:<20} {value:>12.3f}")
+                continue
+            change = (value - old) / abs(old)
+            worse = -change * direction > tolerance
+            mark = "  REGRESSION" if worse else ""
+            print(f"  {metric:<20} {value:>12.3f}  baseline {old:>12.3f}  {change:+7.1%}{mark}")
+            if worse:
+                regressions.append((scenario, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against the local HLS stand-in")
+    parser.add_argument("-s", "--scenario", nargs="*", choices=sorted(SCENARIOS), help="default: all of them")
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the pipeline's own output")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        result = run_scenario(SCENARIOS[args.run_one], direct=args.run_one in DIRECT_SCENARIOS)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return 0
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"[INFO] Running Scenario: {name}")
+        results[name] = run_repeated(name, args.repeat, args.verbose)
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baselines = json.load(f)
+    regressions = compare(results, baselines, args.tolerance)
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"\n[OK] Baselines Saved: {BASELINE_PATH}")
+        return 0
+    if regressions:
+        print(f"\n[WARN] {len(regressions)} Regression(s) Beyond {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
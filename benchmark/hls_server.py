@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+
+from aiohttp import web
+
+TS_PACKET_SIZE = 188
+PTS_CLOCK = 90000
+CONTENT_PID = 0x100
+AD_PID = 0x1011  # another muxer, like the ads spliced in by the real sites
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def _pts_bytes(pts: int):
+    return bytes([0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF, ((pts >> 14) & 0xFE) | 1,
+                  (pts >> 7) & 0xFF, ((pts << 1) & 0xFE) | 1])
+
+
+def make_segment(pts_start: int, seconds: float, pid: int = CONTENT_PID, fps: int = 25, packets_per_frame: int = 8):
+    """
+    A synthetic MPEG-TS segment: one video PES per frame carrying a PTS, a PCR on the first packet
+    and filler packets, continuity counters counting up per PID
+"""
+    out = bytearray()
+    cc = 0
+    for frame in range(int(seconds * fps)):
+        pts = (pts_start + frame * PTS_CLOCK // fps) % (1 << 33)
+        pes = b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05" + _pts_bytes(pts)
+        if frame == 0:
+            af = bytes([0x10, (pts >> 25) & 0xFF, (pts >> 17) & 0xFF, (pts >> 9) & 0xFF, (pts >> 1) & 0xFF,
+                        ((pts & 1) << 7) | 0x7E, 0])
+            header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x30 | cc, len(af)]) + af
+        else:
+            header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10 | cc])
+        packet = header + pes
+        out += packet + b"\xff" * (TS_PACKET_SIZE - len(packet))
+        cc = (cc + 1) % 16
+        for _ in range(packets_per_frame - 1):
+            out += bytes([0x47, pid >> 8, pid & 0xFF, 0x10 | cc]) + b"\xaa" * (TS_PACKET_SIZE - 4)
+            cc = (cc + 1) % 16
+    return bytes(out)
+
+
+class StandInOptions:
+    """Shape of the synthetic site, every knob a benchmark scenario may turn"""
+
+    def __init__(self, name: str = "BenchAnime", episodes: int = 2, segments: int = 60,
+                 segment_seconds: float = 4.0, ad_seconds: float = 2.0, ad_blocks: tuple = (20,),
+                 ad_block_length: int = 3, naming: str = "md5", latency: float = 0.0, bandwidth: float = 0.0,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 2.0,
+                 sources: tuple = ("喵喵云",), broken_sources: tuple = (), encrypt: bool = False, seed: int = 1):
+        """
+        :param ad_blocks: content positions before which an AD block is inserted, in every episode
+        :param naming: "md5" (hash names) or "sequential" (0000000.ts ...)
+        :param latency: seconds before a segment response starts
+        :param bandwidth: bytes per second of one segment response, 0 means unlimited
+        :param error_rate: share of segment requests answered with 503
+        :param slow_rate: share of segment requests delayed by slow_latency, a slow CDN edge
+        :param sources: video source names of the series page, each one serves every episode
+        :param broken_sources: sources whose segments are all answered with 503
+        :param encrypt: AES-128 content segments with one key per series and IVs from the media sequence,
+          the ADs stay clear like spliced ones do
+"""
+        self.name = name
+        self.episodes = episodes
+        self.segments = segments
+        self.segment_seconds = segment_seconds
+        self.ad_seconds = ad_seconds
+        self.ad_blocks = tuple(ad_blocks)
+        self.ad_block_length = ad_block_length
+        self.naming = naming
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.sources = tuple(sources)
+        self.broken_sources = tuple(broken_sources)
+        self.encrypt = encrypt
+        self.seed = seed
+
+
+class StandInServer:
+    """
+    Local stand-in for the anime site and its HLS CDN, shaped like the pages main.py scrapes:
+      /detail/1.html             series page, the XPath of get_episode_list_url
+      /play/ep{n}.html           episode page, the dxfbk.com link of get_episode_m3u8 (s{k}ep{n} for source k > 0)
+      /v/ep{n}/index.m3u8        master playlist with one 1080p variant
+      /v/ep{n}/2000k/hls/mixed.m3u8 and its segments, ADs come from /ad/ between discontinuities
+      /v/ep{n}/2000k/hls/key.key the AES-128 key when the segments are encrypted
+    Runs its own event loop in a daemon thread, so it never competes with the client loop
+"""
+
+    def __init__(self, options: StandInOptions | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.options = options or StandInOptions()
+        self.host = host
+        self.port = port
+        self.hits = {"segment": 0, "ad": 0, "error": 0, "head": 0, "key": 0}
+        self.key = hashlib.md5(f"key-{self.options.seed}".encode()).digest()
+        self._random = random.Random(self.options.seed)
+        self._segments = {}  # name -> (kind, index)
+        self._sequence = {}  # content segment name -> media sequence number, its IV
+        self._bodies = {}
+        self._playlists = {}
+        self._ads = {}  # episode -> set of playlist indices which are ADs
+        self._loop = None
+        self._runner = None
+        self._ready = threading.Event()
+        self._build()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def series_url(self):
+        return f"{self.base_url}/detail/1.html"
+
+    @property
+    def episode_url(self):
+        return f"{self.base_url}/play/"
+
+    def ad_indices(self, episode: int):
+        """Ground truth: playlist indices of the ADs in episode n (1-based)"""
+        return self._ads[episode]
+
+    @staticmethod
+    def _episode_key(source: int, episode: int):
+        return f"ep{episode}" if source == 0 else f"s{source}ep{episode}"
+
+    @staticmethod
+    def _parse_episode_key(key: str):
+        """'ep3' -> (0, 3), 's1ep3' -> (1, 3)"""
+        source, _, episode = key.partition("ep")
+        return int(source[1:]) if source else 0, int(episode)
+
+    def _segment_name(self, episode: int, i: int):
+        if self.options.naming == "sequential":
+            return f"{i:07d}.ts"
+        return hashlib.md5(f"{episode}-{i}".encode()).hexdigest() + ".ts"
+
+    def _build(self):
+        o = self.options
+        for episode in range(1, o.episodes + 1):
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(o.segment_seconds + 0.999)}",
+                     "#EXT-X-MEDIA-SEQUENCE:0"]
+            key_tag = '#EXT-X-KEY:METHOD=AES-128,URI="key.key"'
+            if o.encrypt:
+                lines.append(key_tag)
+            ads = set()
+            index = 0
+            for i in range(o.segments):
+                if i in o.ad_blocks:
+                    lines.append("#EXT-X-DISCONTINUITY")
+                    if o.encrypt:
+                        lines.append("#EXT-X-KEY:METHOD=NONE")
+                    for a in range(o.ad_block_length):
+                        name = hashlib.md5(f"ad-{i}-{a}".encode()).hexdigest() + ".ts"
+                        self._segments[name] = ("ad", a)
+                        lines += [f"#EXTINF:{o.ad_seconds:.3f},", f"{{base}}/ad/{name}"]
+                        ads.add(index)
+                        index += 1
+                    lines.append("#EXT-X-DISCONTINUITY")
+                    if o.encrypt:
+                        lines.append(key_tag)
+                name = self._segment_name(episode, i)
+                self._segments[name] = ("main", i)
+                self._sequence[name] = index
+                lines += [f"#EXTINF:{o.segment_seconds:.3f},", name]
+                index += 1
+            lines.append("#EXT-X-ENDLIST")
+            self._playlists[episode] = "\n".join(lines) + "\n"
+            self._ads[episode] = ads
+
+    def _body(self, name: str):
+        # the bodies are the same in every episode, a content segment's media sequence number is too
+        key = self._segments[name]
+        if key not in self._bodies:
+            o = self.options
+            kind, i = key
+            if kind == "ad":
+                body = make_segment(7_000_000 + i * int(o.ad_seconds * PTS_CLOCK), o.ad_seconds,
+                                    pid=AD_PID, packets_per_frame=12)
+            else:
+                body = make_segment(i * int(o.segment_seconds * PTS_CLOCK), o.segment_seconds)
+                if o.encrypt:
+                    body = self.encrypt(body, self._sequence[name])
+            self._bodies[key] = body
+        return self._bodies[key]
+
+    def encrypt(self, body: bytes, sequence: int):
+        """AES-128-CBC with PKCS7 padding, the IV is the media sequence number when the key tag has none"""
+        # only the encrypted scenario needs cryptography
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(self.key), modes.CBC(sequence.to_bytes(16, "big"))).encryptor()
+        return encryptor.update(padder.update(body) + padder.finalize()) + encryptor.finalize()
+
+    async def _detail(self, request):
+        o = self.options
+        tabs = "".join(f"<a>{source}</a>" for source in o.sources)
+        lists = "".join(
+            '<div class="anthology-list-box none"><div><ul>'
+            + "".join(f'<li><a href="/play/{self._episode_key(k, n)}.html">第{n}集</a></li>'
+                      for n in range(1, o.episodes + 1))
+            + "</ul></div></div>"
+            for k in range(len(o.sources)))
+        html = (f"<html><head><title>《{o.name}》在线观看</title></head><body>"
+                f'<div class="anthology-tab nav-swiper b-b br"><div>{tabs}</div></div>{lists}</body></html>')
+        return web.Response(text=html, content_type="text/html")
+
+    async def _play(self, request):
+        episode = request.match_info["episode"]
+        link = f"{self.base_url}/v/{episode}/index.m3u8"
+        return web.Response(text=f"<a href='https://dxfbk.com/?url={link}' title='play'>", content_type="text/html")
+
+    async def _master(self, request):
+        return web.Response(text="#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1920x1080\n"
+                                 "2000k/hls/mixed.m3u8\n")
+
+    async def _media(self, request):
+        _, episode = self._parse_episode_key(request.match_info["episode"])
+        return web.Response(text=self._playlists[episode].replace("{base}", self.base_url))
+
+    async def _segment(self, request):
+        o = self.options
+        name = request.match_info["name"]
+        entry = self._segments.get(name)
+        if entry is None:
+            raise web.HTTPNotFound()
+        body = self._body(name)
+        if request.method == "HEAD":
+            self.hits["head"] += 1
+            return web.Response(headers={"Content-Length": str(len(body))})
+        if o.latency:
+            await asyncio.sleep(o.latency)
+        if o.slow_rate and self._random.random() < o.slow_rate:
+            await asyncio.sleep(o.slow_latency)
+        episode = request.match_info.get("episode")
+        if episode and o.sources[self._parse_episode_key(episode)[0]] in o.broken_sources:
+            self.hits["error"] += 1
+            raise web.HTTPServiceUnavailable()
+        if o.error_rate and self._random.random() < o.error_rate:
+            self.hits["error"] += 1
+            raise web.HTTPServiceUnavailable()
+        self.hits["ad" if entry[0] == "ad" else "segment"] += 1
+
+        # Range requests resume .part files
+        start = 0
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = min(int(range_header[6:-1]), len(body))
+        response = web.StreamResponse(status=206 if start else 200)
+        response.content_length = len(body) - start
+        if start:
+            response.headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+        await response.prepare(request)
+
+        began = time.perf_counter()
+        for offset in range(start, len(body), STREAM_CHUNK_SIZE):
+            chunk = body[offset:offset + STREAM_CHUNK_SIZE]
+            await response.write(chunk)
+            if o.bandwidth:
+                # pace the body at the configured rate of one connection
+                due = (offset - start + len(chunk)) / o.bandwidth
+                delay = due - (time.perf_counter() - began)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+    async def _key(self, request):
+        if not self.options.encrypt:
+            raise web.HTTPNotFound()
+        self.hits["key"] += 1
+        return web.Response(body=self.key)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/detail/1.html", self._detail)
+        app.router.add_get("/play/{episode}.html", self._play)
+        app.router.add_get("/v/{episode}/index.m3u8", self._master)
+        app.router.add_get("/v/{episode}/2000k/hls/mixed.m3u8", self._media)
+        app.router.add_get("/v/{episode}/2000k/hls/key.key", self._key)
+        app.router.add_get("/v/{episode}/2000k/hls/{name}", self._segment)
+        app.router.add_get("/ad/{name}", self._segment)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Serve in a background thread, returns once the port is bound"""
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            self._ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="hls-stand-in", daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the synthetic HLS site until interrupted")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--episodes", type=int, default=3)
+    parser.add_argument("--segments", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--naming", choices=("md5", "sequential"), default="md5")
+    parser.add_argument("--sources", nargs="*", default=["喵喵云"])
+    parser.add_argument("--broken-sources", nargs="*", default=[])
+    parser.add_argument("--encrypt", action="store_true")
+    args = parser.parse_args()
+
+    server = StandInServer(StandInOptions(episodes=args.episodes, segments=args.segments, latency=args.latency,
+                                          bandwidth=args.bandwidth, error_rate=args.error_rate,
+                                          naming=args.naming, sources=args.sources,
+                                          broken_sources=args.broken_sources, encrypt=args.encrypt),
+                           port=args.port).start()
+    print(f"[INFO] Serving {server.series_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from http_func import fetch
+from metrics_func import metrics
+
+KEY_SIZE = 16  # AES-128
+KEY_TIMEOUT = 20  # seconds for one key request
+DECRYPT_WORKERS = min(8, os.cpu_count() or 2)  # OpenSSL runs without the GIL, one thread per core is enough
+
+_keys = {}  # key url -> key, every key is fetched once per run
+_pending = {}  # key url -> fetch task, the segments asking while it is on the way share it
+_pool = None
+
+
+def _decrypt_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix="decrypt")
+    return _pool
+
+
+async def _fetch_key(url: str, headers):
+    result = await fetch(url, headers=headers, timeout=KEY_TIMEOUT)
+    if len(result.content) != KEY_SIZE:
+        raise ValueError(f"[ERR] Key Of {len(result.content)} Bytes, AES-128 Needs {KEY_SIZE}: {url}")
+    metrics.inc("keys_fetched_total")
+    print(f"[INFO] Key Fetched: {url}")
+    return result.content
+
+
+async def get_key(url: str, headers=None):
+    """The key at url, requested once however many segments use it, a failed request is tried again next time"""
+    key = _keys.get(url)
+    if key is not None:
+        return key
+    pending = _pending.get(url)
+    if pending is None:
+        pending = _pending[url] = asyncio.ensure_future(_fetch_key(url, headers))
+        pending.add_done_callback(lambda _: _pending.pop(url, None))
+    # shielded, a cancelled segment doesn't cancel the request the others wait for
+    key = _keys[url] = await asyncio.shield(pending)
+    return key
+
+
+class SegmentDecryptor:
+    """
+    AES-128-CBC of one segment, fed with the body while it arrives
+    Each chunk is decrypted in the decrypt pool, so there is no pass over the episode afterwards and the event loop
+    stays free. The last block is held back until finish() removes the PKCS7 padding.
+"""
+
+    def __init__(self, key: bytes, iv: bytes):
+        self._decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def _update(self, chunk):
+        return self._unpadder.update(self._decryptor.update(chunk))
+
+    async def update(self, chunk: bytes):
+        """Plain bytes of the complete blocks received so far"""
+        return await asyncio.get_running_loop().run_in_executor(_decrypt_pool(), self._update, chunk)
+
+    def finish(self):
+        """The rest of the plain bytes, raises ValueError when the body is cut off or the key is wrong"""
+        try:
+            return self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+        except ValueError:
+            raise ValueError("[ERR] Segment Not Decrypted, Wrong Key Or Damaged Body") from None
@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+from merge_func import COPY_BUFFER_SIZE
+
+INDEX_SUFFIX = ".idx"  # sidecar index next to the output, {"slots", "done", "tail"} of an unfinished episode
+SAVE_EVERY = 64  # finished segments between two sidecar writes, like the state store batches
+SAVE_DELAY = 1.0  # seconds a finished segment waits at most for the sidecar write when the batch isn't full
+
+
+def _read_at(fd: int, size: int, offset: int):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _write_at(fd: int, data, offset: int):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        if hasattr(os, "pwrite"):
+            written += os.pwrite(fd, view[written:], offset + written)
+        else:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            written += os.write(fd, view[written:])
+    return written
+
+
+def _playlist_key(table):
+    """The sidecar only belongs to the playlist it was planned for"""
+    return hashlib.blake2b("\n".join(table.uris).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _save_index(path: str, data: dict):
+    # replaced atomically, a crash leaves the previous index behind
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+class DirectOutput:
+    """
+    "No cache" mode: the segments are written straight into the output file, there are no segment files
+    Every segment with a known size gets a slot at its playlist position, so the output is already in order and
+    compact_output only closes the holes left by the ADs. A segment whose size was unknown or wrong goes to the
+    tail of the file. The sidecar index records the finished segments, an interrupted episode continues from it.
+"""
+
+    def __init__(self, output_file: str, table, resume: bool = True):
+        self.output_file = output_file
+        self.index_path = output_file + INDEX_SUFFIX
+        self.key = _playlist_key(table)
+        self.names = {}
+        for i, entry in enumerate(table.uris):
+            self.names.setdefault(entry, []).append(i)
+
+        self.slots = {}  # index -> (offset, size) planned from the probed sizes
+        self.done = {}  # index -> (offset, size) written
+        self.tail = 0
+        self.claimed = set()  # indices with a request on the way
+        self._unsaved = 0
+        self._save_timer = None
+        self._lock = threading.Lock()  # only for the lseek + write fallback
+        self._save_lock = threading.Lock()  # the delayed save on the loop and detach() in a worker thread
+
+        data = self._load() if resume else None
+        if data is not None:
+            self.slots = {int(i): tuple(v) for i, v in data["slots"].items()}
+            self.done = {int(i): tuple(v) for i, v in data["done"].items()}
+            self.tail = data["tail"]
+            print(f"[INFO] Direct Output: Continuing With {len(self.done)} Segment(s) Already Written")
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0) | (0 if data is not None else os.O_TRUNC)
+        self._fd = os.open(output_file, flags, 0o644)
+
+    def _load(self):
+        """The sidecar of this playlist, None when missing, foreign or left by an interrupted compaction"""
+        if not os.path.exists(self.output_file):
+            return None
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("playlist") != self.key or data.get("compacting"):
+            return None
+        return data
+
+    def save(self):
+        with self._save_lock:
+            _save_index(self.index_path, {
+                "playlist": self.key,
+                "slots": {str(i): list(v) for i, v in self.slots.items()},
+                "done": {str(i): list(v) for i, v in self.done.items()},
+                "tail": self.tail,
+                "compacting": False,
+            })
+            self._unsaved = 0
+
+    def _save_pending(self):
+        self._save_timer = None
+        if self._unsaved and self._fd is not None:
+            self.save()
+
+    def missing(self, indices):
+        return [i for i in indices if i not in self.done]
+
+    def plan(self, sizes: dict):
+        """
+        Give the segments with a probed size a slot, in playlist order after the existing ones
+        :param sizes: {index: Content-Length or None}, the unknown ones are placed at the tail when they arrive
+"""
+        for i in sorted(sizes):
+            if i in self.slots or i in self.done or sizes[i] is None:
+                continue
+            self.slots[i] = (self.tail, sizes[i])
+            self.tail += sizes[i]
+        self.save()
+
+    def reserve(self, name: str):
+        """
+        Claim the next unwritten index of a playlist entry, once per segment download before any request
+        A hedged duplicate shares the claim of its primary, whichever response arrives first can't take it away
+        :return: index, None when every index of name is written or claimed
+"""
+        for i in self.names.get(name, ()):
+            if i not in self.done and i not in self.claimed:
+                self.claimed.add(i)
+                return i
+        return None
+
+    def place(self, i: int, size: int):
+        """Offset for a response of size bytes: the slot of index i when the size matches, else the tail"""
+        slot = self.slots.get(i)
+        if slot is not None and slot[1] == size:
+            return slot[0]  # a primary and its hedge write the same bytes here
+        return self.allocate(size)
+
+    def allocate(self, size: int):
+        """Space at the tail, for a segment which doesn't fit its slot"""
+        offset = self.tail
+        self.tail += size
+        return offset
+
+    def write(self, data, offset: int):
+        """Called from worker threads, pwrite needs no lock"""
+        if hasattr(os, "pwrite"):
+            return _write_at(self._fd, data, offset)
+        with self._lock:
+            return _write_at(self._fd, data, offset)
+
+    def finish(self, i: int, offset: int, size: int):
+        self.claimed.discard(i)
+        self.done[i] = (offset, size)
+        self._unsaved += 1
+        if self._unsaved >= SAVE_EVERY:
+            self.save()
+        elif self._save_timer is None:
+            # Called on the event loop, a short or stalled episode is saved soon after, not at the next batch
+            self._save_timer = asyncio.get_running_loop().call_later(SAVE_DELAY, self._save_pending)
+
+    def abandon(self, i: int):
+        """A segment given up after its retries, a later download may claim it again"""
+        self.claimed.discard(i)
+
+    def detach(self):
+        """
+        Save the index and close the output, the rest is done by compact_output, in any process
+        :return: {"segments": {index: (offset, size)}} of the written segments
+"""
+        self.save()
+        self.close()
+        return {"segments": dict(self.done)}
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _move(in_fd: int, out_fd: int, src: int, dest: int, size: int):
+    """Copy front to back in bounded chunks, safe inside one file while dest <= src"""
+    moved = 0
+    while moved < size:
+        chunk = _read_at(in_fd, min(COPY_BUFFER_SIZE, size - moved), src + moved)
+        if not chunk:
+            break
+        _write_at(out_fd, chunk, dest + moved)
+        moved += len(chunk)
+    return moved
+
+
+def compact_output(output_file: str, segments: dict, kept: list):
+    """
+    Move the kept segments of a direct output together in playlist order and cut the file after them
+    In place when no segment has to move towards the end of the file or over one not moved yet, which holds
+    whenever every kept segment sits in its slot. Otherwise the output is rewritten into a new file.
+    :param segments: DirectOutput.detach()["segments"]
+    :param kept: playlist indices to keep, in order, the ones never written are left out
+    :return: (written bytes, elapsed seconds, method)
+"""
+    start = time.perf_counter()
+    kept = [i for i in kept if i in segments]
+    index_path = output_file + INDEX_SUFFIX
+    # An interrupted compaction leaves an output no index describes, the next run starts over
+    with open(index_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["compacting"] = True
+    _save_index(index_path, data)
+
+    # lowest source offset among the segments after each one, they are read after it was written
+    lowest_after = {}
+    low = float("inf")
+    for i in reversed(kept):
+        lowest_after[i] = low
+        low = min(low, segments[i][0])
+    in_place = True
+    dest = 0
+    for i in kept:
+        offset, size = segments[i]
+        if dest > offset or dest + size > lowest_after[i]:
+            in_place = False
+            break
+        dest += size
+
+    written = 0
+    if in_place:
+        fd = os.open(output_file, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            for i in kept:
+                offset, size = segments[i]
+                written += _move(fd, fd, offset, written, size) if offset != written else size
+            os.ftruncate(fd, written)
+        finally:
+            os.close(fd)
+    else:
+        temp_file = output_file + ".compact"
+        in_fd = os.open(output_file, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        out_fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            for i in kept:
+                offset, size = segments[i]
+                written += _move(in_fd, out_fd, offset, written, size)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+        os.replace(temp_file, output_file)
+    os.remove(index_path)
+    return written, time.perf_counter() - start, "in place" if in_place else "rewrite"
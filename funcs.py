@@ -1,23 +1,30 @@
+import asyncio
 import os
 import re
-import time
 
-import requests
+import aiohttp
 from bs4 import BeautifulSoup
 
+from http_func import fetch, run_async
+from retry_func import backoff_delay
+
 DEFAULT_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0",
 }
 
 
-def try_to_get(
+async def try_to_get_async(
         url: str,
-        sleep: int = 3,
+        sleep: float | None = None,
         name: str = None,
         chance: int = 3,
         headers=None,
 ):
-    """Try to multiple requests. And return corresponding prompts"""
+    """
+    Try to multiple requests with the shared connection pool. And return corresponding prompts
+    Politeness is the host's rate budget (limiter_func.HostRate), a failed attempt only waits out a jittered backoff
+    :param sleep: fixed seconds between attempts instead of the backoff
+"""
 
     if headers is None:
         headers = DEFAULT_HEADERS
@@ -26,20 +33,30 @@ def try_to_get(
 
     for attempt in range(chance):
         try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            resp.raise_for_status()
-            return resp
-        except requests.RequestException as e:
+            return await fetch(url, headers=headers, timeout=10)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"[WARN] {name} get failed, Count down: {chance - attempt}")
             if attempt < chance - 1:
-                print(f"[INFO] Wait {sleep} seconds and retry...")
-                time.sleep(sleep)
+                delay = sleep if sleep is not None else backoff_delay(attempt + 1)
+                print(f"[INFO] Wait {delay:.1f} seconds and retry...")
+                await asyncio.sleep(delay)
             else:
                 print("[ERR] Request failed, exit program")
 
     print(f"[BREAK] {name} request failed, already tried {chance} times")
 
 
+def try_to_get(
+        url: str,
+        sleep: float | None = None,
+        name: str = None,
+        chance: int = 3,
+        headers=None,
+):
+    """Blocking try_to_get_async, the request still goes through the shared connection pool"""
+    return run_async(try_to_get_async(url, sleep, name, chance, headers))
+
+
 def w_sanitize(name: str = "_") -> str:
     """
     Perform secure processing on the name, ensure it can be saved correctly in Windows Explorer.
@@ -0,0 +1,114 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+from metrics_func import metrics
+
+HEDGE_QUANTILE = 0.95  # a request running longer than this quantile of recent latencies gets a duplicate
+HEDGE_WINDOW = 256  # recent segment latencies the quantile is taken over
+HEDGE_MIN_SAMPLES = 32  # no hedging before the window knows the host
+HEDGE_MIN_DELAY = 0.05  # seconds, a very fast host is not hedged below this
+HEDGE_MAX_RATIO = 0.05  # hedges per segment request, the extra load stays under 5%
+
+_hedgers = {}
+
+
+class Hedger:
+    """
+    Hedged requests of one host: a segment request slower than the rolling p95 of the host gets a duplicate,
+    the first to finish is used and the other one is cancelled
+    The saved time is estimated from the primary's progress when the hedge won, a primary which received a
+    fraction f of the segment in t seconds would have needed about t / f. A primary without any byte yet is
+    counted as one median request away from done, which undercounts a real stall.
+"""
+
+    def __init__(self, quantile: float = HEDGE_QUANTILE, window: int = HEDGE_WINDOW,
+                 max_ratio: float = HEDGE_MAX_RATIO):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self._threshold = None
+        self._stale = 0
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+        self._stale += 1
+
+    def delay(self):
+        """Seconds before a request is hedged, None while there are too few samples"""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        # Sorting 256 floats is cheap, but not on every request
+        if self._threshold is None or self._stale >= 16:
+            ordered = sorted(self.latencies)
+            self._threshold = max(HEDGE_MIN_DELAY, ordered[int(self.quantile * (len(ordered) - 1))])
+            self._stale = 0
+        return self._threshold
+
+    def allow(self):
+        return self.hedges < 1 + self.max_ratio * self.requests
+
+    async def race(self, attempt, size_hint=None):
+        """
+        Run attempt(progress, hedged) and hedge it once it outlives delay()
+        :param attempt: callable returning a coroutine, progress is a one item list of the bytes received so far,
+          hedged is True for the duplicate, which must not collide with the primary's output
+        :param size_hint: callable giving the segment size from the winner's result, for the saved time estimate
+        :return: the first successful result, the primary's exception when both fail
+"""
+        self.requests += 1
+        started = time.monotonic()
+        progress = [0]
+        primary = asyncio.ensure_future(attempt(progress, False))
+        delay = self.delay()
+        tasks = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.allow():
+                    self.hedges += 1
+                    metrics.inc("hedges_total")
+                    hedge_started = time.monotonic()
+                    hedge = asyncio.ensure_future(attempt([0], True))
+                    tasks.add(hedge)
+                    while tasks:
+                        done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            if task.exception() is not None:
+                                continue
+                            elapsed = time.monotonic() - started
+                            if task is hedge:
+                                metrics.inc("hedge_wins_total")
+                                size = size_hint(task.result()) if size_hint else 0
+                                fraction = progress[0] / size if size else 0
+                                if fraction > 0:
+                                    needed = elapsed / fraction
+                                else:
+                                    needed = elapsed + statistics.median(self.latencies)
+                                metrics.inc("hedge_saved_seconds_total", max(0.0, needed - elapsed))
+                                self.observe(time.monotonic() - hedge_started)
+                            else:
+                                self.observe(elapsed)
+                            return task.result()
+                    return primary.result()  # both failed, raises the primary's error
+            result = await primary
+            self.observe(time.monotonic() - started)
+            return result
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_hedger(url: str):
+    """The hedger of url's host, latencies of different CDNs don't mix"""
+    host = urlparse(url).netloc
+    hedger = _hedgers.get(host)
+    if hedger is None:
+        hedger = _hedgers[host] = Hedger()
+    return hedger
@@ -0,0 +1,104 @@
+import asyncio
+import atexit
+import threading
+
+import aiohttp
+
+from limiter_func import get_host_rate
+
+POOL_LIMIT = 256  # connections of the whole process
+POOL_LIMIT_PER_HOST = 72  # the segment limiter tops out at 64, leave a few for pages and playlists
+DNS_CACHE_TTL = 600  # seconds, one CDN host is resolved once per run instead of once per episode
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept for the next request
+
+_loop = None
+_thread = None
+_session = None
+_lock = threading.Lock()
+
+
+class HttpResult:
+    """The parts of a finished response the scrapers use, with the body already read"""
+
+    def __init__(self, url: str, status: int, headers, content: bytes, encoding: str):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+
+def _client_loop():
+    """The event loop owning the shared session, started in a daemon thread on first use"""
+    global _loop, _thread
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name="http-client", daemon=True)
+            _thread.start()
+            atexit.register(_shutdown)
+    return _loop
+
+
+def _in_client_loop():
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+
+def run_async(coro):
+    """
+    Run coro on the client loop and wait for its result.
+    Every async pipeline starts here instead of asyncio.run, so all of them share one connection pool,
+    and blocking callers in worker threads can reach the same pool through run_async too.
+"""
+    loop = _client_loop()
+    if _in_client_loop():
+        coro.close()
+        raise RuntimeError("run_async() would block the client loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+async def get_session():
+    """The process wide ClientSession: keep-alive, DNS cache and per-host connection limits"""
+    global _session
+    if not _in_client_loop():
+        raise RuntimeError("The shared session lives on the client loop, start the coroutine with run_async()")
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(ssl=False, limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST,
+                                         use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def fetch(url: str, headers=None, timeout: float = 10):
+    """GET url with the shared session and read the whole body, raise on HTTP errors, within the host's rate"""
+    session = await get_session()
+    rate = get_host_rate(url)
+    await rate.request()
+    async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        resp.raise_for_status()
+        content = await resp.read()
+        await rate.consume(len(content))
+        return HttpResult(str(resp.url), resp.status, resp.headers, content, resp.get_encoding())
+
+
+async def _close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+def _shutdown():
+    if _loop is None or not _loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_close_session(), _loop).result(timeout=5)
+    except Exception:
+        pass
+    _loop.call_soon_threadsafe(_loop.stop)
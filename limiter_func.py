@@ -0,0 +1,268 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+LIMITS_PATH = "./m3u8/host_limits.json"  # tuned concurrency of every host, reused by later runs
+MIN_CONCURRENCY = 2
+MAX_CONCURRENCY = 64
+INCREASE_STEP = 1  # additive increase when throughput keeps improving
+DECREASE_FACTOR = 0.5  # multiplicative decrease on 429/5xx/timeout
+LATENCY_DECREASE_FACTOR = 0.8  # gentler decrease when latency keeps rising
+LATENCY_TOLERANCE = 2.5  # window latency above this times the best window latency counts as congestion
+THROUGHPUT_GAIN = 1.05  # a window must beat the previous one by 5% to justify one more request
+# Agreed budget of every host: host -> (requests/s, bytes/s), None for no cap, e.g. {"cdn.example.com": (20, 8e6)}
+HOST_RATES = {}
+DEFAULT_HOST_RATE = (None, None)  # hosts missing from HOST_RATES, worker --rate / --bandwidth set it
+RATE_BURST_SECONDS = 1.0  # a bucket holds this many seconds of its rate, an idle host may burst that much
+
+_host_limiters = {}
+_host_rates = {}
+_saved_limits = None
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit, used like a Semaphore: `async with limiter:`
+    Callers report every request with on_success / on_failure, the limit follows the host's capacity
+    """
+
+    def __init__(self, initial: int = 15, min_limit: int = MIN_CONCURRENCY, max_limit: int = MAX_CONCURRENCY):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._in_flight = 0
+        self._waiters = deque()
+
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_latency = 0.0
+        self._last_throughput = None
+        self._best_latency = None
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def acquire(self):
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # the slot was already handed over
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        # Hand the free slots to the waiters directly, in arrival order
+        while self._waiters and self._in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self._in_flight += 1
+            fut.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def on_success(self, latency: float, nbytes: int):
+        """Account a finished request, the limit is re-evaluated once per window of `limit` requests"""
+        self._window_bytes += nbytes
+        self._window_count += 1
+        self._window_latency += latency
+        if self._window_count < max(self.limit, MIN_CONCURRENCY):
+            return
+
+        now = time.monotonic()
+        throughput = self._window_bytes / max(now - self._window_start, 1e-6)
+        avg_latency = self._window_latency / self._window_count
+        if self._best_latency is None or avg_latency < self._best_latency:
+            self._best_latency = avg_latency
+
+        if avg_latency > self._best_latency * LATENCY_TOLERANCE:
+            self._decrease(LATENCY_DECREASE_FACTOR)
+        elif self._last_throughput is None or throughput > self._last_throughput * THROUGHPUT_GAIN:
+            self._limit = min(self.max_limit, self._limit + INCREASE_STEP)
+            self._wake()
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_latency = 0.0
+
+    def on_failure(self, congested: bool = True):
+        """Account a failed request, only congestion signals (429/5xx/timeout) shrink the limit"""
+        if congested:
+            self._decrease(DECREASE_FACTOR)
+
+    def _decrease(self, factor):
+        # The requests already in flight fail together, only cut once per round trip
+        now = time.monotonic()
+        if now - self._last_decrease < (self._best_latency or 1.0):
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * factor)
+        self._last_throughput = None
+
+
+class ByteBudget:
+    """
+    Cap of bytes in flight. The size of a segment is unknown before its response, so every request
+    reserves the running average of the finished segments and hands the reservation back when done
+    """
+
+    def __init__(self, capacity: int, initial_estimate: int = 2 * 1024 * 1024):
+        self.capacity = capacity
+        self.estimate = initial_estimate
+        self._used = 0
+        self._finished = 0
+        self._waiters = deque()
+
+    @property
+    def used(self):
+        return self._used
+
+    async def acquire(self):
+        """Wait until the expected size of one more segment fits, return the reserved byte count"""
+        reserved = min(self.estimate, self.capacity)
+        if not self._waiters and self._used + reserved <= self.capacity:
+            self._used += reserved
+            return reserved
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((reserved, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(reserved)
+            raise
+        return reserved
+
+    def release(self, reserved: int, actual: int | None = None):
+        self._used -= reserved
+        if actual:
+            # Running average, converges after a few segments and then barely moves
+            self._finished += 1
+            self.estimate += (actual - self.estimate) // min(self._finished, 64)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            reserved, fut = self._waiters[0]
+            if not fut.done():
+                if self._used + reserved > self.capacity:
+                    break
+                self._used += reserved
+                fut.set_result(None)
+            self._waiters.popleft()
+
+
+class TokenBucket:
+    """
+    rate tokens per second, at most burst of them saved up
+    A taker may overdraw the bucket and sleeps off its own debt, so concurrent takers queue up in time without
+    a waiter list and the long-run rate is exact, bytes can be taken after they arrived
+"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * RATE_BURST_SECONDS
+        self.tokens = self.burst
+        self._stamp = time.monotonic()
+
+    async def take(self, n: float = 1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class HostRate:
+    """Request and byte budgets of one host, shared by the page fetcher and the segment downloads"""
+
+    def __init__(self, requests_per_second: float | None = None, bytes_per_second: float | None = None):
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    async def request(self):
+        """Wait for the turn of one more request"""
+        if self.requests is not None:
+            await self.requests.take()
+
+    async def consume(self, n: int):
+        """Account n received bytes, sleeps while the host is over its byte budget"""
+        if self.bytes is not None:
+            await self.bytes.take(n)
+
+
+def get_host_rate(url: str):
+    """The rate budget of url's host, from HOST_RATES or DEFAULT_HOST_RATE"""
+    host = urlparse(url).netloc
+    rate = _host_rates.get(host)
+    if rate is None:
+        rate = _host_rates[host] = HostRate(*HOST_RATES.get(host, DEFAULT_HOST_RATE))
+    return rate
+
+
+def is_congestion_error(e: BaseException):
+    """429, 5xx and timeouts mean the host is overloaded, anything else is the request's own problem"""
+    if isinstance(e, asyncio.TimeoutError):
+        return True
+    status = getattr(e, "status", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _load_limits(limits_path):
+    global _saved_limits
+    if _saved_limits is None:
+        try:
+            with open(limits_path, "r", encoding="utf-8") as f:
+                _saved_limits = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _saved_limits = {}
+    return _saved_limits
+
+
+def get_host_limiter(url: str, initial: int = 15, limits_path: str = LIMITS_PATH):
+    """Return the limiter of url's host, a new host starts from its saved limit or from initial"""
+    host = urlparse(url).netloc
+    limiter = _host_limiters.get(host)
+    if limiter is None:
+        start = _load_limits(limits_path).get(host, initial)
+        limiter = AdaptiveLimiter(initial=start)
+        _host_limiters[host] = limiter
+        print(f"[INFO] Concurrency for {host} starts at {limiter.limit}")
+    return limiter
+
+
+def save_host_limits(limits_path: str = LIMITS_PATH):
+    """Persist the tuned limit of every host used in this run"""
+    limits = dict(_load_limits(limits_path))
+    # list() copies the items at once, the download loop may add a host while this runs in a worker thread
+    limits.update({host: limiter.limit for host, limiter in list(_host_limiters.items())})
+    os.makedirs(os.path.dirname(limits_path) or ".", exist_ok=True)
+    with open(limits_path, "w", encoding="utf-8") as f:
+        json.dump(limits, f, indent=2)
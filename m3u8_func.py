@@ -0,0 +1,194 @@
+import os
+import pickle
+import re
+from array import array
+from urllib.parse import urljoin, urlparse
+
+TABLE_SUFFIX = ".idx"  # parsed table cached next to the playlist: video.m3u8.idx
+TABLE_VERSION = 1
+
+obj_attribute = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attributes(text: str):
+    """#EXT-X-KEY:METHOD=AES-128,URI="k.key" -> {'METHOD': 'AES-128', 'URI': 'k.key'}"""
+    return {key: value.strip('"') for key, value in obj_attribute.findall(text)}
+
+
+class SegmentTable:
+    """
+    Every segment of a media playlist, one column per field, index i is the i-th segment
+      - uris: playlist entry as written in the m3u8
+      - durations: EXTINF seconds, -1 when the tag is missing
+      - discontinuity: 1 when #EXT-X-DISCONTINUITY precedes the segment
+      - key_index: index in keys of the #EXT-X-KEY in effect, -1 for clear segments
+      - range_length / range_offset: #EXT-X-BYTERANGE, -1 when the whole resource is the segment
+"""
+
+    def __init__(self):
+        self.uris = []
+        self.durations = array("d")
+        self.discontinuity = array("b")
+        self.key_index = array("i")
+        self.range_length = array("q")
+        self.range_offset = array("q")
+        self.keys = []  # attribute dicts of the #EXT-X-KEY tags
+        self.media_sequence = 0
+        self.target_duration = None
+        self.endlist = False
+
+    def __len__(self):
+        return len(self.uris)
+
+    def append(self, uri, duration, discontinuity, key_index, range_length, range_offset):
+        self.uris.append(uri)
+        self.durations.append(duration)
+        self.discontinuity.append(discontinuity)
+        self.key_index.append(key_index)
+        self.range_length.append(range_length)
+        self.range_offset.append(range_offset)
+
+    def save(self, path: str, source_stat: os.stat_result):
+        with open(path, "wb") as f:
+            pickle.dump((TABLE_VERSION, source_stat.st_size, source_stat.st_mtime_ns, self), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def parse_master_playlist(text: str):
+    """
+    Variants of a master playlist, [] when text is a media playlist
+    :return: [{"uri", "bandwidth", "average_bandwidth", "resolution": (width, height) or None, "codecs"}]
+"""
+    variants = []
+    attributes = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = parse_attributes(line[len("#EXT-X-STREAM-INF:"):])
+        elif line and not line.startswith("#") and attributes is not None:
+            width, _, height = attributes.get("RESOLUTION", "").partition("x")
+            variants.append({
+                "uri": line,
+                "bandwidth": int(attributes.get("BANDWIDTH", 0) or 0),
+                "average_bandwidth": int(attributes.get("AVERAGE-BANDWIDTH", 0) or 0),
+                "resolution": (int(width), int(height)) if width.isdigit() and height.isdigit() else None,
+                "codecs": attributes.get("CODECS"),
+            })
+            attributes = None
+    return variants
+
+
+def choose_variant(variants: list, max_height: int | None = None, max_bandwidth: int | None = None):
+    """
+    The best variant within the limits: highest resolution, then highest bandwidth
+    When nothing fits the limits, the smallest variant is the closest
+"""
+    def rank(variant):
+        height = variant["resolution"][1] if variant["resolution"] else 0
+        return height, variant["average_bandwidth"] or variant["bandwidth"]
+
+    fitting = [v for v in variants
+               if (max_height is None or v["resolution"] is None or v["resolution"][1] <= max_height)
+               and (max_bandwidth is None or (v["average_bandwidth"] or v["bandwidth"]) <= max_bandwidth)]
+    if fitting:
+        return max(fitting, key=rank)
+    return min(variants, key=rank)
+
+
+def parse_m3u8(text: str):
+    """Parse a media playlist in one pass"""
+    table = SegmentTable()
+    duration = -1.0
+    discontinuity = 0
+    key_index = -1
+    range_length, range_offset = -1, -1
+    next_offset = {}  # a BYTERANGE without @offset continues after the previous range of the same uri
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("#"):
+            if range_length >= 0 and range_offset < 0:
+                range_offset = next_offset.get(line, 0)
+            if range_length >= 0:
+                next_offset[line] = range_offset + range_length
+            table.append(line, duration, discontinuity, key_index, range_length, range_offset)
+            duration = -1.0
+            discontinuity = 0
+            range_length, range_offset = -1, -1
+        elif line.startswith("#EXTINF:"):
+            match = re.match(r'#EXTINF:\s*([\d.]+)', line)
+            if match:
+                duration = float(match.group(1))
+        elif line == "#EXT-X-DISCONTINUITY":
+            discontinuity = 1
+        elif line.startswith("#EXT-X-KEY:"):
+            attributes = parse_attributes(line.split(":", 1)[1])
+            if attributes.get("METHOD", "NONE") == "NONE":
+                key_index = -1
+            else:
+                table.keys.append(attributes)
+                key_index = len(table.keys) - 1
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            length, _, offset = line.split(":", 1)[1].partition("@")
+            range_length = int(length)
+            range_offset = int(offset) if offset else -1
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            table.media_sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            table.target_duration = float(line.split(":", 1)[1])
+        elif line == "#EXT-X-ENDLIST":
+            table.endlist = True
+    return table
+
+
+def segment_keys(table, head_url: str):
+    """
+    Key and IV of every encrypted playlist entry
+    Only a playlist with keys needs crypto_func (and cryptography) to decrypt them
+    The IV is the IV attribute of the key tag, or else the segment's media sequence number as a 128-bit big-endian
+    integer, as the HLS spec says
+    :return: {entry: (key url, iv)}, empty for a clear playlist, raises ValueError for encryptions other than AES-128
+"""
+    keys = {}
+    for i, entry in enumerate(table.uris):
+        k = table.key_index[i]
+        if k < 0 or entry in keys:
+            continue
+        attributes = table.keys[k]
+        method = attributes.get("METHOD")
+        if method != "AES-128" or attributes.get("KEYFORMAT", "identity") != "identity":
+            raise ValueError(f"[ERR] Unsupported Encryption: {method} {attributes.get('KEYFORMAT', '')}".rstrip())
+        if "IV" in attributes:
+            iv = int(attributes["IV"], 16).to_bytes(16, "big")
+        else:
+            iv = (table.media_sequence + i).to_bytes(16, "big")
+        keys[entry] = (urljoin(head_url, attributes["URI"]), iv)
+    return keys
+
+
+def load_segment_table(m3u8_path: str):
+    """Parsed table of a m3u8 file, read from the cache next to it while the playlist is unchanged"""
+    source_stat = os.stat(m3u8_path)
+    cache_path = m3u8_path + TABLE_SUFFIX
+    try:
+        with open(cache_path, "rb") as f:
+            version, size, mtime_ns, table = pickle.load(f)
+        if version == TABLE_VERSION and size == source_stat.st_size and mtime_ns == source_stat.st_mtime_ns:
+            return table
+    except (FileNotFoundError, EOFError, ValueError, pickle.UnpicklingError, AttributeError):
+        pass
+
+    with open(m3u8_path, "r", encoding="utf-8") as f:
+        table = parse_m3u8(f.read())
+    try:
+        table.save(cache_path, source_stat)
+    except OSError as e:
+        print(f"[WARN] Segment Table Cache Not Saved: {e}")
+    return table
+
+
+def segment_path(save_dir: str, entry: str):
+    """Local path of a playlist entry, every segment of an episode is saved flat in its own folder"""
+    return os.path.join(save_dir, os.path.basename(urlparse(entry).path))
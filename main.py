@@ -1,38 +1,68 @@
+import argparse
 import asyncio
 import os
 import random
+import statistics
 import string
 import sys
 import time
-from urllib.parse import urljoin
+from functools import partial
+from urllib.parse import urljoin, urlparse
 import aiofiles
 import aiohttp
 import re
 from lxml import etree
 from pathlib import Path
 
-from ad_filter_func import ads_detect_analyze_ts_pattern, ads_detect_by_sequence, ads_detect_by_duration, \
-    ads_detect_by_filesize
-from funcs import try_to_get, w_sanitize, safe_remove_continue, menu_select
+from batch_func import parse_episode_ranges, split_episode_ranges, rank_sources, describe_probe, load_job_file
+from ad_fingerprint_func import known_ads_by_url
+from http_func import get_session, run_async
+import state_store
+from funcs import try_to_get, w_sanitize, menu_select
+from limiter_func import AdaptiveLimiter, ByteBudget, get_host_limiter, get_host_rate, save_host_limits, \
+    is_congestion_error
+from plan_func import plan_download, confirm_deferred
+from m3u8_func import parse_m3u8, parse_master_playlist, choose_variant, load_segment_table, segment_path, \
+    segment_keys, TABLE_SUFFIX
+from metrics_func import metrics, report_progress, progress_text
+from stream_merge_func import StreamingMerger
+from direct_output_func import DirectOutput, INDEX_SUFFIX
+from hedge_func import get_hedger
+import limiter_func
+import postprocess_func
+from postprocess_func import postprocess_episode
+from verify_func import verify_segments, scan_segment_dir, finished_rows
+from retry_func import RetryBudget, backoff_delay, is_retryable_error, SEGMENT_RETRIES
 # ATTENTION: config was put in gitignore
 from config import URL, HEADERS, Episode_URL
 
 obj_find_anime_name = re.compile(r'<title>《(?P<name>.*?)》.*?</title>', re.S)
 obj_find_index_m3u8 = re.compile(r"https://dxfbk.com/\?url=(.*?)' title=", re.S)
+_probed_throughput = {}  # host -> bits/s estimated by probe_throughput
 
 #  ======================= PARAMS =======================
-HISTORY_PATH = "./m3u8/history.txt"
 is_new_anime = False
+SEGMENT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=20)
+MAX_ACTIVE_EPISODES = 2  # episodes allowed to download at the same time
+PREFETCH_EPISODES = 3  # episodes whose pages and playlists are resolved ahead of the downloads
+SOURCE_PROBE_SEGMENTS = 4  # segments downloaded from every source to measure it, spread over its first episode
+PROBE_SOURCES = True  # measure the sources before the interactive source menu
+SEGMENT_CHUNK_SIZE = 64 * 1024  # segments are streamed to disk, memory scales with this instead of segment size
+SEGMENT_QUEUE_SIZE = 256  # segment names waiting for a worker
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024  # bytes allowed on the way at once, across every episode
+DIRECT_OUTPUT = False  # no cache: write the segments straight into the output file, see direct_output_func
+VERIFY_CHECKSUMS = False  # record a checksum of every segment and compare them when resuming, else size and mtime
+RESOLUTION_TTL = 6 * 3600  # seconds a page -> master -> media resolution is reused, the links carry tokens
+VARIANT_MAX_HEIGHT = 1080  # highest resolution worth downloading, None for the best one offered
+VARIANT_MAX_BANDWIDTH = None  # bits/s cap on the variant, None for no cap
+VARIANT_MIN_SPEEDUP = None  # e.g. 4: probe the host, keep the variants it delivers 4x faster than realtime
+METRICS_PATH = "./m3u8/metrics.jsonl"  # one JSON line per export, name it '*.prom' for the Prometheus text format
 
 
 def get_episode_list_url(url: str):
     """
     download the list about the episode number, avoid possible request interruptions
-    FORMAT:
-    # episode_1
-    example//1.com
-    # episode_2
-    example//2.com
+    Every source and its (episode number, link) pairs are saved in the state store
     :param url: which source code includes the episode download link
 """
     resp = try_to_get(url, name="Home source code", headers=HEADERS)
@@ -55,54 +85,92 @@ def get_episode_list_url(url: str):
 
     #  Check the Path and father folder is existed? If not, create it
     Path(path).mkdir(parents=True, exist_ok=True)
-    #  Delete the old file
-    safe_remove_continue(f"{path}/cache/downloadList.txt")
-
-    source_index = 0
-    with open(f"{path}/cache/downloadList.txt", "a", encoding="utf-8") as f:
-        f.write(str("-Video-Source: "))
-        for source in source_list:
-            source = w_sanitize(source)
-            f.write("-" + source)
-        f.write("\n")
-
-        for div in divs:
-            lis = div.xpath('./li/a')
-            reso_list = []  # The address of each video source, the last was the length
-            f.write(f"========= {w_sanitize(source_list[source_index])} =========\n")
-            source_index += 1
-            for li in lis:
-                episode_link = li.xpath('./@href')[0].split('/')[-1]
-                episode_num = li.xpath('normalize-space(./text())')
-                # Write the episode_num and download link
-                f.write(f"# {episode_num}\n")
-                f.write(f"{Episode_URL + episode_link}\n")
-                reso_list.append(Episode_URL)
+
+    sources = [w_sanitize(source) for source in source_list]
+    episodes = []
+    for div in divs:
+        source_episodes = []
+        for li in div.xpath('./li/a'):
+            episode_link = li.xpath('./@href')[0].split('/')[-1]
+            episode_num = li.xpath('normalize-space(./text())')
+            source_episodes.append((episode_num, Episode_URL + episode_link))
+        episodes.append(source_episodes)
+    # Replaces the old list of this series
+    state_store.save_episode_list(name, sources, episodes)
     print("[OK] All links have been successfully retrieved! Now attempting to download....")
     return name
 
 
+def probe_throughput(master_url: str, variant: dict):
+    """
+    Estimate the download rate of a host in bits/s: time one segment of the variant on one connection and scale
+    it by the host's concurrency limit, segments are fetched in parallel. Measured once per host and run.
+"""
+    host = urlparse(master_url).netloc
+    if host in _probed_throughput:
+        return _probed_throughput[host]
+    throughput = None
+    media_url = urljoin(master_url, variant["uri"])
+    resp = try_to_get(media_url, name="Probe Playlist", headers=HEADERS, chance=1)
+    if resp is not None:
+        table = parse_m3u8(resp.text)
+        if len(table):
+            segment_url = urljoin(media_url, table.uris[0])
+            started = time.perf_counter()
+            segment = try_to_get(segment_url, name="Probe Segment", headers=HEADERS, chance=1)
+            elapsed = time.perf_counter() - started
+            if segment is not None and elapsed > 0:
+                throughput = len(segment.content) * 8 / elapsed * get_host_limiter(segment_url).limit
+                print(f"[INFO] Probed {host}: ~{throughput / 1e6:.1f} Mbit/s")
+    _probed_throughput[host] = throughput
+    return throughput
+
+
+def resolve_variant(master_url: str, text: str):
+    """
+    Pick the media playlist of a master playlist by the variant policy in PARAMS
+    :return: media playlist url, master_url itself when it is a media playlist already
+"""
+    variants = parse_master_playlist(text)
+    if not variants:
+        return master_url
+    max_bandwidth = VARIANT_MAX_BANDWIDTH
+    if VARIANT_MIN_SPEEDUP and len(variants) > 1:
+        throughput = probe_throughput(master_url, choose_variant(variants, VARIANT_MAX_HEIGHT, max_bandwidth))
+        if throughput:
+            # the variant must download VARIANT_MIN_SPEEDUP times faster than it plays
+            fits = throughput / VARIANT_MIN_SPEEDUP
+            max_bandwidth = min(max_bandwidth or fits, fits)
+    variant = choose_variant(variants, VARIANT_MAX_HEIGHT, max_bandwidth)
+    resolution = "x".join(map(str, variant["resolution"])) if variant["resolution"] else "?"
+    print(f"[INFO] Variant {resolution} @ {variant['bandwidth'] / 1000:.0f} kbit/s "
+          f"Chosen From {len(variants)}: {variant['uri']}")
+    return urljoin(master_url, variant["uri"])
+
+
 def get_episode_m3u8(url: str, path: str):
     """
     Fetch m3u8 Url for Source code, return m3u8 download link
+    The page -> master -> media chain is cached for RESOLUTION_TTL, a repeated lookup costs no request
     :param url: which can get the ndex.m3u8 link
-    :param path: which can save head_url
+    :param path: episode cache folder, head_url is saved for it
 """
-    resp = try_to_get(url, name="Index Link For M3U8", headers=HEADERS)
-
-    m3u8_link = obj_find_index_m3u8.findall(resp.text)[0]  # 'https://???/20250708/19470_e0b22023/index.m3u8'
-    print(f"[OK] Successfully Obtained Index Link For M3U8: {m3u8_link}, Currently Concatenating URLs...")
-    resp_m3u8 = try_to_get(m3u8_link, name="M3U8 Request Link Suffix", headers=HEADERS)
-    lines = resp_m3u8.content.splitlines()
-    last_line = lines[-1].decode("utf-8")  # last_line = 2000k/hls/mixed.m3u8
-    m3u8_url = urljoin(m3u8_link, last_line)  # https://???/20250708/19470_e0b22023/2000k/hls/mixed.m3u8
+    cached = state_store.get_resolution(url, RESOLUTION_TTL)
+    if cached:
+        m3u8_link, m3u8_url = cached
+        print(f"[OK] Playlist Link Resolved From Cache: {m3u8_url}")
+    else:
+        resp = try_to_get(url, name="Index Link For M3U8", headers=HEADERS)
+
+        m3u8_link = obj_find_index_m3u8.findall(resp.text)[0]  # 'https://???/20250708/19470_e0b22023/index.m3u8'
+        print(f"[OK] Successfully Obtained Index Link For M3U8: {m3u8_link}, Currently Concatenating URLs...")
+        resp_m3u8 = try_to_get(m3u8_link, name="M3U8 Request Link Suffix", headers=HEADERS)
+        # https://???/20250708/19470_e0b22023/2000k/hls/mixed.m3u8
+        m3u8_url = resolve_variant(m3u8_link, resp_m3u8.text)
+        state_store.save_resolution(url, m3u8_link, m3u8_url)
     head_url = m3u8_url.rsplit("/", 1)[0] + "/"  # 'https://???/20250708/19470_e0b22023/2000k/hls/' m3u8 Request URL
 
-    file_path = urljoin(path, "file/data.txt")
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(f"#HEAD_URL:{head_url}")
+    state_store.save_playlist(path, head_url=head_url, m3u8_url=m3u8_url)
 
     print("[OK] Successfully Obtained Genuine M3U8 Request Link, Start to Download M3U8 File...")
     return head_url, m3u8_url
@@ -117,348 +185,804 @@ def download_m3u8(m3u8_url: str, address: str):
     result = try_to_get(m3u8_url, name="M3U8 File", headers=HEADERS)
     save_address = urljoin(address, "file/video.m3u8")
     print(f"[INFO] M3U8 save in{save_address}")
+    os.makedirs(os.path.dirname(save_address), exist_ok=True)
     with open(save_address, "wb") as f:
         f.write(result.content)
+
+    # Parse once and cache the table next to the playlist, every later stage reads the table
+    table = parse_m3u8(result.text)
+    table.save(save_address + TABLE_SUFFIX, os.stat(save_address))
+    state_store.save_segments(address, table.uris)
+    state_store.save_playlist(address, m3u8_url=m3u8_url, complete=table.endlist)
     print(f"[OK] .m3u8 File Download Successful, Save path: {save_address}")
 
 
-async def download_ts(url: str, filename: str, session: aiohttp.ClientSession, sem: asyncio.Semaphore):
+async def fetch_segment(url: str, part_path: str, session: aiohttp.ClientSession, progress: list | None = None,
+                        cipher=None):
+    """
+    Stream one segment into part_path, continuing an existing partial file with a Range request
+    :param progress: one item list, kept at the size of the part file while the body arrives
+    :param cipher: callable giving a fresh crypto_func.SegmentDecryptor, for an AES-128 segment, which is
+      decrypted while it arrives and always fetched whole, the part
+      file holds plain bytes which can't continue the CBC chain
+    :return: (bytes transferred by this request, total size of the part file)
+"""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) and cipher is None else 0
+    headers = HEADERS
+    if offset:
+        # identity encoding, the offset must count the bytes of the file itself
+        headers = {**HEADERS, "Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
+
+    async with session.get(url, headers=headers, timeout=SEGMENT_TIMEOUT) as resp:
+        if resp.status == 416:
+            os.remove(part_path)  # the part file can't be continued, start over on the next attempt
+        resp.raise_for_status()
+        if offset and (resp.status != 206 or not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-")):
+            offset = 0  # the server ignored the Range header, the body is the whole segment
+
+        received = written = 0
+        rate = get_host_rate(url)
+        decryptor = cipher() if cipher is not None else None
+        async with aiofiles.open(part_path, 'ab' if offset else 'wb') as f:
+            async for chunk in resp.content.iter_chunked(SEGMENT_CHUNK_SIZE):
+                received += len(chunk)
+                if progress is not None:
+                    progress[0] = offset + received
+                await rate.consume(len(chunk))
+                if decryptor is not None:
+                    chunk = await decryptor.update(chunk)
+                await f.write(chunk)
+                written += len(chunk)
+
+        # Content-Length is the encoded size when the body was compressed, only compare plain bodies
+        expected = resp.content_length
+        if expected is not None and "Content-Encoding" not in resp.headers and received != expected:
+            raise IOError(f"Incomplete segment, received {offset + received} of {offset + expected} bytes")
+        if decryptor is not None:
+            tail = decryptor.finish()
+            async with aiofiles.open(part_path, 'ab') as f:
+                await f.write(tail)
+            written += len(tail)
+
+    return received, offset + written
+
+
+async def fetch_segment_direct(url: str, index: int, output: DirectOutput, session: aiohttp.ClientSession,
+                               progress: list | None = None, cipher=None):
+    """
+    Stream one segment into its slot of the direct output. A segment without a slot of its size goes to the tail,
+    its body is read whole first when the response doesn't tell the length.
+    A failed attempt starts the segment over, the bytes it wrote are overwritten.
+    :param index: playlist index claimed with DirectOutput.reserve by the caller, shared by a hedged duplicate
+    :param progress: one item list, kept at the bytes received while the body arrives
+    :param cipher: callable giving a fresh crypto_func.SegmentDecryptor, the plain bytes are up to 16 shorter and
+      fit the slot
+    :return: (bytes transferred by this request, segment size)
+"""
+    async with session.get(url, headers=HEADERS, timeout=SEGMENT_TIMEOUT) as resp:
+        resp.raise_for_status()
+        # Content-Length is the encoded size when the body was compressed
+        length = resp.content_length if "Content-Encoding" not in resp.headers else None
+        rate = get_host_rate(url)
+        decryptor = cipher() if cipher is not None else None
+        if length is None:
+            body = await resp.read()
+            await rate.consume(len(body))
+            received = len(body)
+            if decryptor is not None:
+                body = await decryptor.update(body) + decryptor.finish()
+            offset = output.allocate(len(body))
+            await asyncio.to_thread(output.write, body, offset)
+            written = len(body)
+        else:
+            offset = output.place(index, length)
+            received = written = 0
+            async for chunk in resp.content.iter_chunked(SEGMENT_CHUNK_SIZE):
+                if received + len(chunk) > length:
+                    raise IOError(f"Segment longer than its {length} bytes")  # would overwrite the next one
+                received += len(chunk)
+                if progress is not None:
+                    progress[0] = received
+                await rate.consume(len(chunk))
+                if decryptor is not None:
+                    chunk = await decryptor.update(chunk)
+                await asyncio.to_thread(output.write, chunk, offset + written)
+                written += len(chunk)
+            if received != length:
+                raise IOError(f"Incomplete segment, received {received} of {length} bytes")
+            if decryptor is not None:
+                tail = decryptor.finish()
+                await asyncio.to_thread(output.write, tail, offset + written)
+                written += len(tail)
+    output.finish(index, offset, written)
+    return received, written
+
+
+async def probe_segment_sizes(head_url: str, names: dict, session: aiohttp.ClientSession,
+                              limiter: AdaptiveLimiter | None = None):
+    """
+    HEAD the deferred segments, their Content-Length feeds the size check without downloading them
+    A fixed pool of workers takes the segments in turn, each HEAD holds a slot of the host's limiter like a download
+    :param names: {index: playlist entry}
+    :param limiter: concurrency limit of the segment host, defaults to the limiter of head_url's host
+    :return: {index: size or None}
+"""
+    if limiter is None:
+        limiter = get_host_limiter(head_url)
+    sizes = dict.fromkeys(names)
+    pending = iter(names.items())
+
+    async def probe():
+        for i, entry in pending:
+            url = entry if entry.startswith(("http://", "https://")) else urljoin(head_url, entry)
+            await get_host_rate(url).request()
+            # Not reported to the limiter, a body-less response says nothing about the host's throughput
+            async with limiter:
+                try:
+                    async with session.head(url, headers=HEADERS, timeout=SEGMENT_TIMEOUT,
+                                            allow_redirects=True) as resp:
+                        if resp.status == 200 and "Content-Encoding" not in resp.headers:
+                            sizes[i] = resp.content_length
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+
+    # Enough workers for the limiter to grow into, the limiter decides how many really run
+    workers = [asyncio.create_task(probe()) for _ in range(min(limiter.max_limit, len(names)))]
     try:
-        async with sem:  # concurrency limit
-            async with session.get(url, headers=HEADERS) as resp:
-                resp.raise_for_status()
-                content = await resp.read()
-
-            os.makedirs('./m3u8', exist_ok=True)
-            dest_path = os.path.join('./m3u8', filename)
-            # ensure the parent path exist
-            dest_dir = os.path.dirname(dest_path)
-            if dest_dir:
-                os.makedirs(dest_dir, exist_ok=True)
-
-            async with aiofiles.open(dest_path, 'wb') as f:
-                await f.write(content)
-
-        print(f"{filename} Successful")
-        return True
-    except Exception as e:
-        print(f"{filename} Failed: {e}")
-        return e  # return the abnormal data
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+    return sizes
+
+
+async def download_ts(url: str, filename: str, session: aiohttp.ClientSession, limiter: AdaptiveLimiter,
+                      save_dir: str = "./m3u8", retry_budget: RetryBudget | None = None,
+                      output: DirectOutput | None = None, key: tuple | None = None):
+    """
+    Stream one segment to '<name>.part' and rename it when complete, so a finished name is always a whole segment
+    Failed attempts are retried with backoff, continuing from the bytes already received
+    A request slower than the host's recent p95 is hedged with a duplicate (hedge_func), the first one wins
+    :param filename: playlist entry of the segment
+    :param limiter: adaptive concurrency limit of the segment host, fed with the outcome of this request
+    :param save_dir: episode cache folder
+    :param retry_budget: retries shared by the episode, only the per-segment limit applies when None
+    :param output: write into this direct output instead of a segment file
+    :param key: (key url, iv) of an AES-128 segment, see m3u8_func.segment_keys
+    :return: bytes written, or the exception
+"""
+    if output is None:
+        os.makedirs(save_dir, exist_ok=True)
+        dest_path = segment_path(save_dir, filename)
+        part_path = dest_path + ".part"
+        hedge_path = dest_path + ".hedge.part"  # the duplicate streams to its own file, the winner is renamed
+    else:
+        # Claimed before the first request, the retries and a hedged duplicate all write this index
+        index = output.reserve(filename)
+        if index is None:
+            e = IOError("Every position of the segment is written or claimed already")
+            metrics.inc("segments_total", result="failed")
+            print(f"{filename} Failed: {e}")
+            return e
+    if retry_budget is not None:
+        retry_budget.on_request()
+
+    rate = get_host_rate(url)
+    hedger = get_hedger(url)
+    cipher = None
+
+    async def fetch_once(progress, hedged):
+        if hedged:
+            await rate.request()  # the duplicate is one more request to the host
+        metrics.add_gauge("requests_in_flight", 1)
+        try:
+            if output is not None:
+                return *await fetch_segment_direct(url, index, output, session, progress, cipher), None
+            path = hedge_path if hedged else part_path
+            return *await fetch_segment(url, path, session, progress, cipher), path
+        finally:
+            metrics.add_gauge("requests_in_flight", -1)
+
+    attempt = 0
+    while True:
+        try:
+            if key is not None and cipher is None:
+                # cryptography is only imported for an encrypted playlist
+                from crypto_func import SegmentDecryptor, get_key
+                # one request per key, the rest hit the cache
+                cipher = partial(SegmentDecryptor, await get_key(key[0], HEADERS), key[1])
+            # The request rate is waited for before the concurrency slot, a waiting request holds no slot
+            await rate.request()
+            async with limiter:  # concurrency limit
+                started = time.monotonic()
+                received, size, path = await hedger.race(fetch_once, size_hint=lambda result: result[1])
+                if output is None:
+                    os.replace(path, dest_path)  # atomic, a crash never leaves a truncated .ts behind
+                    loser = hedge_path if path == part_path else part_path
+                    if os.path.exists(loser):
+                        os.remove(loser)
+                latency = time.monotonic() - started
+                limiter.on_success(latency, received)
+
+            # Counted, not printed: the progress line reports them at a fixed rate
+            metrics.inc("segments_total", result="ok")
+            metrics.inc("segment_bytes_total", received)
+            metrics.observe("segment_seconds", latency)
+            return size
+        except Exception as e:
+            limiter.on_failure(congested=is_congestion_error(e))
+            attempt += 1
+            if (attempt > SEGMENT_RETRIES or not is_retryable_error(e)
+                    or (retry_budget is not None and not retry_budget.take())):
+                metrics.inc("segments_total", result="failed")
+                print(f"{filename} Failed: {e}")
+                if output is not None:
+                    output.abandon(index)
+                return e  # return the abnormal data
+
+            metrics.inc("segment_retries_total")
+            metrics.inc("segment_errors_total", error=type(e).__name__)
+            await asyncio.sleep(backoff_delay(attempt))  # outside the limiter, the slot serves other segments
 
 
 async def download_video(head_url: str, path: str = None, pattern: str = "M",
-                         tasks: list | None = None, concurrency: int = 15):
+                         tasks: list | None = None, concurrency: int = 15, save_dir: str = "./m3u8",
+                         session: aiohttp.ClientSession | None = None, limiter: AdaptiveLimiter | None = None,
+                         byte_budget: ByteBudget | None = None, on_result=None, skip: set | None = None,
+                         output: DirectOutput | None = None, keys: dict | None = None):
     """
     download m3u8 video concurrency
+    A fixed pool of workers pulls segment names from a bounded queue, so memory doesn't grow with the playlist
 
     :param head_url: segments (base url)
     :param path: m3u8 path (pattern == "M")
     :param pattern: "M": download m3u8 file, "T" according to the task list
     :param tasks: the task list which need download (pattern != "M")
-    :param concurrency: concurrency request limit
+    :param concurrency: starting concurrency for a host without a tuned limit
+    :param save_dir: folder where the segments are saved
+    :param session: defaults to the process wide session
+    :param limiter: shared adaptive limit, defaults to the limiter of head_url's host
+    :param byte_budget: shared cap of bytes in flight, a private one is used when None
+    :param on_result: callback(name, result) for every segment, result is the byte count or the exception
+    :param skip: segment names which are not downloaded (known or deferred ADs)
+    :param output: direct output the segments are written into, save_dir gets no segment files then
+    :param keys: {name: (key url, iv)} of the encrypted segments, taken from the m3u8 file when None (pattern == "M")
+    :return: names of the failed segments
     """
-    names = []
-
     if pattern == "M":
         if not path:
             raise ValueError("[ERR] Must offer path (m3u8 file), When pattern == 'M'")
-        async with aiofiles.open(path, "r", encoding="utf-8") as f:
-            async for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                names.append(line)
+        table = await asyncio.to_thread(load_segment_table, path)
+        names = table.uris
+        if keys is None:
+            keys = segment_keys(table, head_url)
     else:
         if tasks is None:
             raise ValueError("[ERR] Must offer tasks list, When pattern != 'M'")
-        names = list(tasks)
-
-    if not names:
-        print("No segments to download.")
-        return
-
-    connector = aiohttp.TCPConnector(ssl=False)
-    sem = asyncio.Semaphore(concurrency)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        download_tasks = []
+        if not tasks:
+            print("No segments to download.")
+            return []
+        names = tasks
+
+    if limiter is None:
+        limiter = get_host_limiter(head_url, initial=concurrency)
+    if byte_budget is None:
+        byte_budget = ByteBudget(MAX_INFLIGHT_BYTES)
+    if session is None:
+        session = await get_session()
+
+    queue = asyncio.Queue(maxsize=SEGMENT_QUEUE_SIZE)
+    retry_budget = RetryBudget()
+    failed = []
+    counter = {"total": 0, "done": 0, "skipped": 0}
+
+    async def produce():
         for name in names:
+            if skip and name in skip:
+                counter["skipped"] += 1
+                continue
+            await queue.put(name)
+        for _ in range(limiter.max_limit):
+            await queue.put(None)  # one stop signal per worker
+
+    async def work():
+        while (name := await queue.get()) is not None:
+            counter["total"] += 1
             if name.startswith("http://") or name.startswith("https://"):
                 download_url = name
             else:
                 download_url = urljoin(head_url, name)
-            download_tasks.append(asyncio.create_task(download_ts(download_url, name, session, sem)))
 
-        results = await asyncio.gather(*download_tasks, return_exceptions=True)
+            # Reserve the expected size first, the request waits while too many bytes are on the way
+            reserved = await byte_budget.acquire()
+            result = None
+            try:
+                result = await download_ts(download_url, name, session, limiter, save_dir, retry_budget, output,
+                                           keys.get(name) if keys else None)
+            finally:
+                byte_budget.release(reserved, result if isinstance(result, int) else None)
+
+            if isinstance(result, Exception):
+                failed.append(name)
+            else:
+                counter["done"] += 1
+            if on_result is not None:
+                on_result(name, result)
+
+    # Enough workers for the limiter to grow into, the limiter decides how many really run
+    workers = [asyncio.create_task(work()) for _ in range(limiter.max_limit)]
+    try:
+        await asyncio.gather(produce(), *workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    if counter["skipped"]:
+        metrics.inc("segments_total", counter["skipped"], result="skipped")
+        print(f"[INFO] {counter['skipped']} Known or Suspected AD Segment(s) Not Downloaded")
+    if not counter["total"]:
+        print("No segments to download.")
+        return []
+    print(f"[INFO] Concurrency settled at {limiter.limit}")
 
-    failed = [r for r in results if isinstance(r, Exception)]
+    if retry_budget.used:
+        print(f"[INFO] {retry_budget.used} Retries Used")
     if failed:
         print(f"{len(failed)} segments failed.")
     else:
         print("All segments downloaded successfully.")
 
-    return results
-
+    return failed
 
-def merge_m3u8(m3u8_path, output_file, auto_detect=True, manual_review=False):
-    ts_list = []
-    ad_list = []
 
-    # Read m3u8 File
-    with open(m3u8_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            ts_list.append(line)
+def get_source_list(anime_name: str):
+    source_list = state_store.get_sources(anime_name)
+    if not source_list:
+        print(f"[ERR] No video source recorded for {anime_name}")
+    return source_list
 
-    print(f"M3U8 File Contains {len(ts_list)} Fragment(s)")
 
-    if not auto_detect:
-        # don't auto analyze, merge file directly.
-        print("[INFO] Auto-Detection Disabled, Merging All Segments...")
-        filtered_list = ts_list
-    else:
-        # analyze the naming patterns
-        main_pattern, patterns = ads_detect_analyze_ts_pattern(ts_list)
-        print(f"[DBG] Naming Pattern Analysis: {patterns}")
-        print(f"[DBG] Main Pattern: {main_pattern}")
-
-        ad_indices = set()
-        # according to the naming patterns to choice the analysis strategies
-        if main_pattern == 'sequential':
-            # Continuous number naming: using the sequence analysis
-            print("[INFO] Using Sequence-Based AD Detection...")
-            ad_indices = set(ads_detect_by_sequence(ts_list))
-
-        elif main_pattern == 'md5_hash':
-            # MD5-hash naming：using the duration analysis + file size analysis
-            print("[INFO] Detected MD5-Hash Naming, Using Multi-Strategy Detection...")
-
-            # Strategy1: duration analysis
-            try:
-                duration_ads = set(ads_detect_by_duration(ts_list, m3u8_path))
-                print(f"[DBG] Duration-Based Detection: {len(duration_ads)} suspicious segments")
-            except Exception as e:
-                print(f"[WARN] Duration Analysis Failed: {e}")
-                duration_ads = set()
+def choice_video_source(anime_name, source_index):
+    return state_store.get_episodes(anime_name, source_index)
 
-            # Strategy2: Analyze file size
-            try:
-                size_ads = set(ads_detect_by_filesize(ts_list))
-                print(f"[DBG] Size-Based Detection: {len(size_ads)} suspicious segments")
-            except Exception as e:
-                print(f"[WARN] Size Analysis Failed: {e}")
-                size_ads = set()
-            # Take the intersection (both methods consider labeling as AD)
-            ad_indices = duration_ads & size_ads
-            print(f"[INFO] Confirmed AD Segments (Intersection): {len(ad_indices)}")
-            # If there is no intersection, it means the analysis not unreliable and no segments will be deleted
-            if not ad_indices:
-                print("[INFO] No Reliable AD Detection, Keeping All Segments")
 
-        else:
-            # other states: conservative strategy, not delete
-            print("[INFO] Mixed/Unknown Naming Pattern, Skipping AD Detection")
-            ad_indices = set()
-        # Build a filtered list
-        filtered_list = []
-        for i, entry in enumerate(ts_list):
-            if i in ad_indices:
-                ad_list.append(os.path.basename(entry))
-            else:
-                # Remain m3u8 relative path
-                candidate = entry
-                if not os.path.isabs(candidate) and not candidate.startswith("http"):
-                    candidate = os.path.join("./m3u8", os.path.basename(entry))
-                filtered_list.append(candidate)
-
-    if ad_list:
-        print(f"\n[INFO] Identified {len(ad_list)} AD Segment(s) (Will Be Filtered):")
-        # Only show the first 20 to avoid flooding the screen
-        for ad in ad_list[:20]:
-            print(f"  - {ad}")
-        if len(ad_list) > 20:
-            print(f"  ... and {len(ad_list) - 20} more")
-
-        # if it needs the manual confirmation
-        if manual_review:
-            response = input("\n[?] Proceed with filtering? (y/n, default=y): ").strip().lower()
-            if response == 'n':
-                print("[INFO] Filtering Cancelled, Merging All Segments...")
-                filtered_list = ts_list
-    else:
-        print("[INFO] No AD Segments Detected")
+def retrieve_history_downloadList(url, check_history=True):
+    if check_history is False:
+        return "not found"
 
-    print(f"\n[INFO] Will Merge {len(filtered_list)} Segment(s)...")
+    anime_name = state_store.get_series_name(url)
+    if anime_name:
+        print(f"[OK] Obtain historical download records, get the name: {anime_name}")
+        return anime_name
+    print("[INFO] History DownloadList Not Found, Start to request...")
+    return "not found"
 
-    # Merge ts Files
-    try:
-        with open(output_file, "wb") as outfile:
-            for ts_file in filtered_list:
-                if not os.path.exists(ts_file):
-                    print(f"[WARN] File Not Exist - {ts_file}")
-                    continue
 
-                with open(ts_file, "rb") as infile:
-                    outfile.write(infile.read())
+def retrieve_history_m3u8(search_path, check_history=True):
+    if not check_history:
+        return False
 
-        print(f"\n[SUCCESS] Output File: {os.path.abspath(output_file)}")
-        print(f"[INFO] File Size: {os.path.getsize(output_file) / 1024 / 1024:.2f} MB")
+    playlist = state_store.get_playlist(search_path)
+    if playlist and playlist[0] and playlist[2] and os.path.exists(urljoin(search_path, "file/video.m3u8")):
+        print("[OK] M3U8, HEAD_URL Retrieve Successful")
+        return True, playlist[0]
+    print("[INFO] No m3u8 download history found")
+    return False
 
-    except Exception as e:
-        print(f"[ERR] Merge Failed: {e}")
 
+def check_m3u8_files(path, full=False):
+    """
+    Check if all ts files in the m3u8 list exist, with one scan of the episode folder
+    :param path: m3u8 and ts file path
+    :param full: verify checksums as well, else compare size and mtime with the recorded ones
+    :return: ts file name which don't exist (tasks) or "all files exist"
+"""
+    ts_list = load_segment_table(urljoin(path, "file/video.m3u8")).uris
+    if not state_store.has_segments(path):
+        # Playlist saved before the state store existed
+        state_store.save_segments(path, ts_list)
 
-def get_source_list(m3u8_path: str):
-    source_list = []
+    tasks, verified = verify_segments(path, ts_list, state_store.get_segment_manifest(path), full=full)
+    state_store.mark_segments_missing(path, tasks)
+    state_store.mark_segments_done(path, verified)
 
-    try:
-        with open(m3u8_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                # Check if it starts with # Video Source:
-                if line.startswith("-Video-Source:"):
-                    content = line.split(":", 1)[1].strip()
-                    # according to '#' Split and clean each source
-                    sources = [item.strip() for item in content.split("-") if item.strip()]
-                    source_list.extend(sources)
-
-    except FileNotFoundError:
-        print(f"[ERR] File: {m3u8_path} not found")
-    except Exception as e:
-        print(f"[ERR] Read file fail {e}")
+    if tasks:
+        return tasks
+    else:
+        return "all files exist"
 
-    return source_list
 
+def episode_cache_dir(anime_name: str, episode_name: str, source_name: str):
+    return f"./m3u8/{anime_name}/cache/{episode_name}_{source_name}/"
 
-def choice_video_source(path, source_index):
-    episode_number = []
-    episode_link = []
 
-    with open(path, "r", encoding="utf-8") as f:
-        start_processing = False
+def episode_output_file(anime_name: str, episode_name: str, source_name: str):
+    return f"./m3u8/{anime_name}/{anime_name + episode_name + source_name}.ts"
 
-        for line in f:
-            line = line.strip()
-            if line.startswith("="):
-                if start_processing:
-                    break
-                source_index -= 1
-                if source_index <= 0:
-                    start_processing = True
-                else:
-                    start_processing = False
-                    continue
-            elif start_processing:
-                if line.startswith("#"):
-                    episode_number.append(line.strip("# "))
-                elif line.startswith("-"):
-                    continue
-                else:
-                    episode_link.append(line.strip(" "))
-    return episode_number, episode_link
 
+def episode_merged(output_file: str):
+    """
+    The output is complete: merges and streamed outputs are renamed into place when finished, and a direct
+    output keeps its sidecar index until the compaction is done
+"""
+    return os.path.exists(output_file) and not os.path.exists(output_file + INDEX_SUFFIX)
 
-def retrieve_history_downloadList(url, search_path, check_history=True):
-    if check_history is False:
-        return "not found"
 
-    history_path = Path(search_path)
-    history_path.parent.mkdir(parents=True, exist_ok=True)  # Ensure m3u8 folder exist
+async def resolve_episode(link: str, g_path: str, after: asyncio.Event | None = None):
+    """
+    Scrape the episode page and fetch its playlists, run as a task ahead of the episode's download
+    :param after: set when the episode PREFETCH_EPISODES places earlier starts downloading, keeps the resolver
+      a bounded window ahead instead of resolving the whole series (the links carry expiring tokens)
+    :return: (head_url, segment table)
+"""
+    if after is not None:
+        await after.wait()
+    # Page scraping is blocking, keep it off the event loop
+    m3u8file_result = await asyncio.to_thread(retrieve_history_m3u8, g_path, True)
+    if m3u8file_result:
+        m3u8_head_url = m3u8file_result[1]
+    else:
+        with metrics.stage("scrape"):
+            m3u8_head_url, video_m3u8_url = await asyncio.to_thread(get_episode_m3u8, link, g_path)
+        with metrics.stage("playlist"):
+            await asyncio.to_thread(download_m3u8, video_m3u8_url, g_path)
+    table = await asyncio.to_thread(load_segment_table, f"{g_path}file/video.m3u8")
+    return m3u8_head_url, table
 
-    if not history_path.exists():
-        history_path.touch()
 
-    with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith(f"{url}="):
-                anime_name = line.split("=")[1]
-                print(f"[OK] Obtain historical download records, get the name: {anime_name}")
-                return anime_name
-    print("[INFO] History DownloadList Not Found, Start to request...")
-    return "not found"
+async def probe_source(anime_name: str, source_name: str, source_index: int, session: aiohttp.ClientSession):
+    """
+    Measure one video source: resolve its first episode and download a few of its segments at once
+    The resolved playlist is kept, downloading that episode later doesn't resolve it again
+    :return: {"name", "index", "episodes", "links", "throughput" (bytes/s, None when it couldn't be resolved),
+      "latency" (median seconds to the first byte), "error_rate" (share of failed sample segments)}
+"""
+    numbers, links = await asyncio.to_thread(choice_video_source, anime_name, source_index)
+    probe = {"name": source_name, "index": source_index, "episodes": numbers, "links": links,
+             "throughput": None, "latency": None, "error_rate": 1.0}
+    if not links:
+        return probe
+    g_path = episode_cache_dir(anime_name, numbers[0], source_name)
+    try:
+        head_url, table = await resolve_episode(links[0], g_path)
+    except Exception as e:
+        print(f"[WARN] Source {source_name} Could Not Be Resolved: {e}")
+        return probe
+    # The segments the plan suspects to be ADs often come from another host, they say nothing about the source
+    deferred = await asyncio.to_thread(plan_download, table, head_url)
+    candidates = [i for i in range(len(table)) if i not in deferred]
+    step = max(1, len(candidates) // SOURCE_PROBE_SEGMENTS)
+    sample = candidates[step // 2::step][:SOURCE_PROBE_SEGMENTS]
+
+    async def fetch_sample(entry):
+        url = entry if entry.startswith(("http://", "https://")) else urljoin(head_url, entry)
+        rate = get_host_rate(url)
+        await rate.request()
+        started = time.monotonic()
+        async with session.get(url, headers=HEADERS, timeout=SEGMENT_TIMEOUT) as resp:
+            resp.raise_for_status()
+            first_byte = time.monotonic() - started
+            body = await resp.read()
+        await rate.consume(len(body))
+        return first_byte, len(body)
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(fetch_sample(table.uris[i]) for i in sample), return_exceptions=True)
+    elapsed = time.monotonic() - started
+    measured = [result for result in results if not isinstance(result, BaseException)]
+    probe["error_rate"] = 1 - len(measured) / len(results) if results else 1.0
+    probe["throughput"] = sum(size for _, size in measured) / max(elapsed, 1e-6)
+    if measured:
+        probe["latency"] = statistics.median(first_byte for first_byte, _ in measured)
+    return probe
+
+
+async def probe_sources(anime_name: str, sources: list, preferred=()):
+    """Probe every source of a series at once and rank them, see batch_func.rank_sources"""
+    session = await get_session()
+    with metrics.stage("probe"):
+        probes = await asyncio.gather(*(probe_source(anime_name, name, index, session)
+                                        for index, name in enumerate(sources, 1)))
+    ranked = rank_sources(probes, preferred)
+    for n, probe in enumerate(ranked, 1):
+        print(f"[INFO] Source #{n} {describe_probe(probe)}")
+    return ranked
+
+
+async def process_episode(anime_name: str, episode_name: str, source_name: str, check_existing: bool,
+                          session: aiohttp.ClientSession, byte_budget: ByteBudget,
+                          episode_sem: asyncio.Semaphore, resolving: asyncio.Task, started: asyncio.Event):
+    """
+    Download one episode and merge it, the merge runs in a worker process so the next episode keeps the link busy
+    :param check_existing: only download the segments which are missing in the cache folder, VERIFY_CHECKSUMS
+      compares their checksums too
+    :param byte_budget: cap of segment bytes in flight, shared by every episode
+    :param episode_sem: limit of episodes downloading at the same time
+    :param resolving: the episode's resolve_episode task, usually done before a download slot frees up
+    :param started: set once this episode holds a download slot or failed, releases the resolver of a later one
+"""
+    g_path = episode_cache_dir(anime_name, episode_name, source_name)
+    output_file = episode_output_file(anime_name, episode_name, source_name)
+    finished = []
+    saving = []
+    merger = None
+    output = None
+
+    def save_finished(batch):
+        state_store.mark_segments_done(g_path, finished_rows(g_path, batch, VERIFY_CHECKSUMS))
+
+    def record(name, result):
+        if merger is None:
+            return  # direct output, its sidecar index records the segments
+        # Batch the state store writes, one transaction per 64 segments, written by a worker thread
+        if isinstance(result, int):
+            finished.append((name, result))
+            merger.add(name, result)
+        if len(finished) >= 64:
+            saving.append(asyncio.create_task(asyncio.to_thread(save_finished, finished[:])))
+            finished.clear()
 
+    try:
+        # Resolved outside the slot, a slow page never holds up the segments of another episode
+        m3u8_head_url, table = await resolving
+        async with episode_sem:
+            started.set()
+            known_ads = await asyncio.to_thread(known_ads_by_url, m3u8_head_url, table)
+            # Suspected ADs from the playlist alone wait until the size check below needs them
+            deferred = await asyncio.to_thread(plan_download, table, m3u8_head_url) - known_ads
+            skip = {table.uris[i] for i in known_ads | deferred}
+            keys = segment_keys(table, m3u8_head_url)
+            if keys:
+                # Fails the episode once, instead of every segment on its own
+                try:
+                    import crypto_func
+                except ImportError:
+                    raise ImportError("[ERR] Encrypted Playlist, Decrypting It Needs 'pip install cryptography'") \
+                        from None
+                print(f"[INFO] {len(keys)} Segment(s) Encrypted With {len(set(k for k, _ in keys.values()))} "
+                      f"AES-128 Key(s), Decrypted While Downloading")
+            if DIRECT_OUTPUT:
+                output = await asyncio.to_thread(DirectOutput, output_file, table, check_existing)
+            else:
+                # The output grows in playlist order while the segments arrive
+                merger = await asyncio.to_thread(StreamingMerger, table, g_path, output_file, known_ads)
+
+            with metrics.stage("download"):
+                probed = {}
+                failed = []
+                if output is not None:
+                    todo = output.missing(i for i in range(len(table)) if i not in known_ads)
+                    # One HEAD per segment places it in the output before it arrives, deferred ones included
+                    probed = await probe_segment_sizes(m3u8_head_url, {i: table.uris[i] for i in todo}, session)
+                    await asyncio.to_thread(output.plan, probed)
+                    failed = await download_video(m3u8_head_url, pattern="T", save_dir=g_path, session=session,
+                                                  tasks=[table.uris[i] for i in todo if i not in deferred],
+                                                  byte_budget=byte_budget, keys=keys, output=output)
+                elif check_existing:
+                    task_list = await asyncio.to_thread(check_m3u8_files, g_path, VERIFY_CHECKSUMS)
+                    merger.seed(await asyncio.to_thread(scan_segment_dir, g_path))
+                    if task_list != "all files exist":
+                        print(task_list[:20])
+                        failed = await download_video(m3u8_head_url, pattern="T", tasks=task_list, save_dir=g_path,
+                                                      session=session, byte_budget=byte_budget, keys=keys,
+                                                      on_result=record, skip=skip)
+                else:
+                    failed = await download_video(m3u8_head_url, pattern="M", path=f"{g_path}file/video.m3u8",
+                                                  save_dir=g_path, session=session, byte_budget=byte_budget,
+                                                  keys=keys, on_result=record, skip=skip)
+                planned_ads = set()
+                if deferred:
+                    if output is None:
+                        probed = await probe_segment_sizes(m3u8_head_url, {i: table.uris[i] for i in deferred},
+                                                           session)
+                    written = {i: size for i, (_, size) in output.done.items()} if output is not None else None
+                    planned_ads, fetch = await asyncio.to_thread(confirm_deferred, table, deferred, g_path, probed,
+                                                                 written)
+                    if output is not None:
+                        fetch = output.missing(fetch)
+                    print(f"[INFO] Deferred Segments: {len(planned_ads)} Confirmed AD, {len(fetch)} Fetched")
+                    if merger is not None:
+                        merger.exclude(planned_ads)
+                    if fetch:
+                        failed += await download_video(m3u8_head_url, pattern="T", tasks=[table.uris[i] for i in fetch],
+                                                       save_dir=g_path, session=session, byte_budget=byte_budget,
+                                                       keys=keys, on_result=record, output=output)
+            await asyncio.gather(*saving, asyncio.to_thread(save_finished, finished))
+            await asyncio.to_thread(save_host_limits)
+            if failed:
+                # Merging around the holes would hide them, the episode fails and another source may have it
+                raise IOError(f"[ERR] {len(failed)} Segment(s) Failed")
+    except BaseException:
+        started.set()
+        if merger is not None:
+            merger.close()  # an output of an earlier run is left as it was
+        if output is not None:
+            output.detach()  # the next run continues from the sidecar index
+        raise
+
+    # Detection and merging go to the process pool, this episode's slot is already free for the next download
+    streamed = direct = None
+    if output is not None:
+        direct = await asyncio.to_thread(output.detach)
+    else:
+        streamed = await asyncio.to_thread(merger.detach)
+    await postprocess_episode(urljoin(g_path, "file/video.m3u8"), output_file, g_path, m3u8_head_url,
+                              planned_ads, streamed, direct)
+    print(f"[OK] {episode_name} download successful!")
 
-def retrieve_history_m3u8(search_path, check_history=True):
-    if not check_history:
-        return False
 
+async def run_download_jobs(anime_name: str, source_name: str | list, episode_number: list, episode_link: list,
+                            start: int, end: int, check_existing: bool = True,
+                            max_active_episodes: int = MAX_ACTIVE_EPISODES, on_episode=None):
+    """
+    Download episodes [start, end) in one event loop, start it with http_func.run_async.
+    source_name is one source for every episode, or a list parallel to episode_number when they come from several.
+    All segments share the process wide session and the adaptive concurrency budget of their host, so the tail of
+    episode N overlaps the head of episode N+1, and merging overlaps with the next downloads.
+    Pages and playlists are resolved up to PREFETCH_EPISODES episodes ahead of the downloads.
+    With check_existing, an episode whose output is already merged is skipped without scraping it again.
+    :param on_episode: callback(i, result) run in a worker thread as soon as episode i is merged or has failed,
+      result is None or the exception, an interrupted run keeps what it has recorded
+    """
+    byte_budget = ByteBudget(MAX_INFLIGHT_BYTES)
+    episode_sem = asyncio.Semaphore(max_active_episodes)
+    source_names = source_name if isinstance(source_name, list) else [source_name] * len(episode_number)
+
+    session = await get_session()
+    progress = asyncio.create_task(report_progress(METRICS_PATH))
+    started = [asyncio.Event() for _ in range(start, end)]
+    async def tracked(i, episode):
+        try:
+            result = await episode
+        except Exception as e:
+            result = e
+        if on_episode is not None:
+            await asyncio.to_thread(on_episode, i, result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    jobs = []
+    for n, i in enumerate(range(start, end)):
+        if check_existing and episode_merged(episode_output_file(anime_name, episode_number[i], source_names[i])):
+            print(f"[OK] {episode_number[i]} Already Merged, Skipped")
+            started[n].set()
+            jobs.append(asyncio.create_task(tracked(i, asyncio.sleep(0))))
+            continue
+        g_path = episode_cache_dir(anime_name, episode_number[i], source_names[i])
+        after = started[n - PREFETCH_EPISODES] if n >= PREFETCH_EPISODES else None
+        resolving = asyncio.create_task(resolve_episode(episode_link[i], g_path, after))
+        jobs.append(asyncio.create_task(tracked(i, process_episode(
+            anime_name, episode_number[i], source_names[i], check_existing, session, byte_budget, episode_sem,
+            resolving, started[n]))))
     try:
-        # Read video.m3u8
-        m3u8_path = urljoin(search_path, "file/video.m3u8")
-        with open(m3u8_path, 'r', encoding='utf-8') as f:
-            last_line = None
-            for line in f:
-                last_line = line.strip()
-
-        # Read data.txt
-        data_path = urljoin(search_path, "file/data.txt")
-        head_url = None
-        with open(data_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith("#HEAD_URL:"):
-                    head_url = line.split(":", 1)[1].strip()
-                    break
-
-        if last_line and '#EXT-X-ENDLIST' in last_line and head_url:
-            print("[OK] M3U8, HEAD_URL Retrieve Successful")
-            return True, head_url
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+    finally:
+        progress.cancel()
+
+    for i, result in zip(range(start, end), results):
+        if isinstance(result, Exception):
+            metrics.inc("episodes_total", result="failed")
+            print(f"[ERR] {episode_number[i]} failed: {result}")
         else:
-            print("[INFO] No m3u8 download history found")
-            return False
-
-    except FileNotFoundError:
-        print("[INFO] No m3u8 download history found")
-        return False
+            metrics.inc("episodes_total", result="ok")
+    print(progress_text())
+    await asyncio.to_thread(metrics.export, METRICS_PATH)
+    return results
 
 
-def check_m3u8_files(path):
+async def run_job(job_id: int, url: str, preferred_sources: list, episodes: str):
     """
-    Check if all ts files in the m3u8 list exist
-    :param path: m3u8 and ts file path
-    :return: ts file name which don't exist (tasks) or "all files exist"
+    Download one queued series, the episodes finished by an earlier run of the same job are not touched again
+    Every episode comes from the best ranked source offering it, an episode failing there fails over to the next
+    :return: number of failed episodes
 """
-    ts_list = []
-    tasks = []
-
-    # read m3u8 file
-    with open(urljoin(path, "file/video.m3u8"), encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            ts_list.append(line)
+    anime_name = await asyncio.to_thread(state_store.get_series_name, url)
+    if anime_name is None:
+        with metrics.stage("scrape"):
+            anime_name = await asyncio.to_thread(get_episode_list_url, url)
+        await asyncio.to_thread(state_store.save_series, url, anime_name)
+    else:
+        print(f"[OK] Obtain historical download records, get the name: {anime_name}")
+
+    sources = get_source_list(anime_name)
+    if not sources:
+        raise ValueError("[ERR] The Series Has No Source")
+    # Episodes are numbered after the longest source, a shorter one lacks the episodes past its end
+    names = max((choice_video_source(anime_name, index)[0] for index in range(1, len(sources) + 1)), key=len)
+    done = state_store.get_done_job_episodes(job_id)
+    todo = [i for i in parse_episode_ranges(episodes, len(names)) if i not in done]
+    print(f"[INFO] Job {job_id}: {anime_name}, {len(todo)} Episode(s) To Download, {len(done)} Already Done")
+    if not todo:
+        return 0
+
+    def record(n, result):
+        # A merged episode is recorded right away, a later crash doesn't download it again
+        if not isinstance(result, Exception):
+            state_store.mark_job_episodes(job_id, [(assigned[n][0], "done")])
+
+    ranked = await probe_sources(anime_name, sources, preferred_sources)
+    tried = {i: set() for i in todo}
+    statuses = []
+    pending = todo
+    while pending:
+        # Every episode goes to the best source which has it and hasn't failed it yet
+        assigned = []
+        for i in pending:
+            probe = next((p for p in ranked if p["name"] not in tried[i] and names[i] in p["episodes"]), None)
+            if probe is None:
+                statuses.append((i, "failed"))
+            else:
+                tried[i].add(probe["name"])
+                assigned.append((i, probe))
+        if not assigned:
+            break
+
+        results = await run_download_jobs(
+            anime_name, [probe["name"] for _, probe in assigned], [names[i] for i, _ in assigned],
+            [probe["links"][probe["episodes"].index(names[i])] for i, probe in assigned],
+            0, len(assigned), check_existing=True, on_episode=record)
+        pending = []
+        for (i, probe), result in zip(assigned, results):
+            if isinstance(result, Exception):
+                print(f"[WARN] {names[i]} Failed On {probe['name']}, Failing Over To The Next Source")
+                pending.append(i)
+            else:
+                statuses.append((i, "done"))
+    # The failures are only final once every source was tried
+    state_store.mark_job_episodes(job_id, [(i, status) for i, status in statuses if status == "failed"])
+    return sum(status == "failed" for _, status in statuses)
 
-    # Check if each ts file exists
-    for ts in ts_list:
-        ts_path = os.path.join(path, ts)
-        if not os.path.exists(ts_path):
-            tasks.append(ts)
 
-    if tasks:
-        return tasks
-    else:
-        return "all files exist"
+async def run_worker(poll_interval: float | None = None):
+    """
+    Drain the job queue in one event loop, every job shares the session, the host limits and the state store
+    A job interrupted by a crash or Ctrl+C is picked up first by the next worker
+    :param poll_interval: keep waiting for new jobs, checking every poll_interval seconds, None stops when empty
+"""
+    while True:
+        job = await asyncio.to_thread(state_store.claim_job)
+        if job is None:
+            if poll_interval is None:
+                print("[INFO] Job Queue Is Empty")
+                return
+            await asyncio.sleep(poll_interval)
+            continue
+
+        job_id, url, preferred_sources, episodes = job
+        try:
+            failed = await run_job(job_id, url, preferred_sources, episodes)
+        except Exception as e:
+            print(f"[ERR] Job {job_id} Failed: {e}")
+            state_store.finish_job(job_id, "failed", str(e))
+            continue
+        if failed:
+            state_store.finish_job(job_id, "failed", f"{failed} episode(s) failed")
+        else:
+            state_store.finish_job(job_id, "done")
 
 
-if __name__ == '__main__':
-    anime_name = retrieve_history_downloadList(URL, HISTORY_PATH, check_history=True)
+def run_interactive():
+    """The original prompt flow for the series in config.URL"""
+    global is_new_anime
+    anime_name = retrieve_history_downloadList(URL, check_history=True)
 
     if anime_name == "not found":
         is_new_anime = True
-        anime_name = get_episode_list_url(URL)
+        with metrics.stage("scrape"):
+            anime_name = get_episode_list_url(URL)
         print("[INFO] Save this download request")
-        with open(HISTORY_PATH, "a", encoding="utf-8") as g:
-            g.write(f"{URL}={anime_name}\n")
-
-    DOWNLOAD_LIST_PATH = f"./m3u8/{anime_name}/downloadList.txt"
-
-    #  Choice the download source
-    source_list = get_source_list(DOWNLOAD_LIST_PATH)
-    source_choice_name, source_choice_index = menu_select("Choice download source", source_list)
-    episode_number, episode_link = choice_video_source(DOWNLOAD_LIST_PATH, source_choice_index)
+        state_store.save_series(URL, anime_name)
+
+    #  Choice the download source, measured ones are offered best first
+    source_list = get_source_list(anime_name)
+    if PROBE_SOURCES and len(source_list) > 1:
+        ranked = run_async(probe_sources(anime_name, source_list))
+        _, choice = menu_select("Choice download source", [describe_probe(probe) for probe in ranked])
+        source_choice_name, source_choice_index = ranked[choice - 1]["name"], ranked[choice - 1]["index"]
+    else:
+        source_choice_name, source_choice_index = menu_select("Choice download source", source_list)
+    episode_number, episode_link = choice_video_source(anime_name, source_choice_index)
 
     print(episode_number)
     print(episode_link)
@@ -468,27 +992,61 @@ if __name__ == '__main__':
     download_video_index_start = int(input("Input download start index: \n > "))
     download_video_index_end = int(input("Input download end index: \n > "))
 
-    for i in range(download_video_index_start - 1, download_video_index_end):
-        g_path = f"./m3u8/{anime_name}/cache/{episode_number[i]}_{source_choice_name}/"
+    run_async(run_download_jobs(anime_name, source_choice_name, episode_number, episode_link,
+                                download_video_index_start - 1, download_video_index_end,
+                                check_existing=not is_new_anime))
+    print("Mission Complete!")
 
-        m3u8file_result = retrieve_history_m3u8(g_path, check_history=True)
-        if m3u8file_result:
-            m3u8_head_url = m3u8file_result[1]
-        else:
-            m3u8_head_url, video_m3u8_url = get_episode_m3u8(episode_link[i], g_path)  # Page source code URL
-            download_m3u8(video_m3u8_url, g_path)
-
-        if not is_new_anime:
-            task_list = check_m3u8_files(g_path)
-            if task_list != "all files exist":
-                display_list = task_list[:20]
-                print(display_list)
-                asyncio.run(download_video(m3u8_head_url, path=g_path, pattern="T", tasks=task_list))
-        else:
-            asyncio.run(download_video(m3u8_head_url, pattern="M", path=f"{g_path}file/video.m3u8"))
 
-        merge_m3u8(urljoin(g_path, "file/video.m3u8"),
-                   f"./m3u8/{anime_name}/{anime_name + episode_number[i] + source_choice_name}.ts")
-        print(f"{episode_number[i]} download successful! now sleep 5 second...")
-        time.sleep(5)
-    print("Mission Complete!")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download m3u8 series, interactively when no command is given")
+    commands = parser.add_subparsers(dest="command")
+    add_parser = commands.add_parser("add", help="queue series for the batch worker")
+    add_parser.add_argument("urls", nargs="*", help="series page URLs")
+    add_parser.add_argument("-f", "--file", help='JSON job file: [{"url": ..., "sources": [...], "episodes": "1-12"}]')
+    add_parser.add_argument("-s", "--sources", nargs="*", default=[], help="source names in order of preference")
+    add_parser.add_argument("-e", "--episodes", default="", help="episode ranges, e.g. 1-12,15,20- (default: all)")
+    worker_parser = commands.add_parser("worker", help="download every queued job")
+    worker_parser.add_argument("--wait", type=float, metavar="SECONDS",
+                               help="keep running and check the queue every SECONDS once it is empty")
+    worker_parser.add_argument("--rate", type=float, metavar="REQUESTS",
+                               help="requests per second allowed to every host without an entry in HOST_RATES")
+    worker_parser.add_argument("--bandwidth", type=float, metavar="MB",
+                               help="MB per second allowed to every host without an entry in HOST_RATES")
+    worker_parser.add_argument("--no-cache", action="store_true",
+                               help="write the segments straight into the output, no segment files are kept")
+    worker_parser.add_argument("--verify", action="store_true",
+                               help="checksum every downloaded segment and verify the checksums when resuming")
+    worker_parser.add_argument("--postprocess-workers", type=int, default=postprocess_func.POSTPROCESS_WORKERS,
+                               help="processes detecting ADs and merging finished episodes")
+    commands.add_parser("jobs", help="list the queued jobs")
+    commands.add_parser("retry", help="queue the failed jobs again")
+    args = parser.parse_args()
+
+    if args.command is None:
+        run_interactive()
+    elif args.command == "add":
+        # A malformed range fails here, not in the worker
+        try:
+            split_episode_ranges(args.episodes)
+            jobs = [(url, args.sources, args.episodes) for url in args.urls]
+            if args.file:
+                jobs += load_job_file(args.file, args.sources, args.episodes)
+        except ValueError as e:
+            parser.error(str(e))
+        if not jobs:
+            parser.error("add needs series URLs or --file")
+        for url, sources, episodes in jobs:
+            print(f"[OK] Job {state_store.enqueue_job(url, sources, episodes)} Queued: {url}")
+    elif args.command == "worker":
+        postprocess_func.POSTPROCESS_WORKERS = max(1, args.postprocess_workers)
+        DIRECT_OUTPUT = DIRECT_OUTPUT or args.no_cache
+        VERIFY_CHECKSUMS = VERIFY_CHECKSUMS or args.verify
+        limiter_func.DEFAULT_HOST_RATE = (args.rate, args.bandwidth and args.bandwidth * 1024 * 1024)
+        run_async(run_worker(args.wait))
+        print("Mission Complete!")
+    elif args.command == "jobs":
+        for job_id, url, status, done, error in state_store.list_jobs():
+            print(f"{job_id:>4}  {status:<8} {done:>4} done  {url}" + (f"  ({error})" if error else ""))
+    elif args.command == "retry":
+        print(f"[OK] {state_store.requeue_failed_jobs()} Failed Job(s) Queued Again")
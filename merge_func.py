@@ -0,0 +1,125 @@
+import errno
+import os
+import time
+
+COPY_BUFFER_SIZE = 1024 * 1024  # bounded buffer for the fallback copy, RSS stays flat whatever the segment size
+# errors which mean "this kernel / filesystem can't do it", try the next method instead of failing the merge
+_UNSUPPORTED_ERRNO = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP}
+
+
+def _copy_by_copy_file_range(in_fd, out_fd, size, out_offset, buffer):
+    """Kernel side copy, data never enters user space (Linux 4.5+)"""
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(in_fd, out_fd, size - copied, copied, out_offset + copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _copy_by_sendfile(in_fd, out_fd, size, out_offset, buffer):
+    """Kernel side copy through sendfile, the output must be positioned first"""
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        n = os.sendfile(out_fd, in_fd, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _copy_by_buffer(in_fd, out_fd, size, out_offset, buffer):
+    """Portable copy with one reusable buffer"""
+    view = memoryview(buffer)
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+    copied = 0
+    with os.fdopen(os.dup(in_fd), "rb", buffering=0) as infile:
+        while copied < size:
+            n = infile.readinto(view)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(out_fd, view[written:n])
+            copied += n
+    return copied
+
+
+def copy_methods():
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(("copy_file_range", _copy_by_copy_file_range))
+    if hasattr(os, "sendfile") and os.name == "posix":
+        methods.append(("sendfile", _copy_by_sendfile))
+    methods.append(("buffer", _copy_by_buffer))
+    return methods
+
+
+def _preallocate(out_fd, total):
+    """Reserve the output size up front, so the file system can lay it out in one piece"""
+    if total <= 0:
+        return
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(out_fd, 0, total)
+            return
+    except OSError:
+        pass
+    os.ftruncate(out_fd, total)
+
+
+def copy_segment(methods: list, ts_file: str, size: int, out_fd: int, out_offset: int, buffer: bytearray):
+    """Copy one segment to out_offset with the first working method, the unsupported ones are dropped from methods"""
+    in_fd = os.open(ts_file, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        while True:
+            name, method = methods[0]
+            try:
+                return method(in_fd, out_fd, size, out_offset, buffer)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNO or len(methods) == 1:
+                    raise
+                print(f"[DBG] {name} unsupported here ({e}), falling back")
+                methods.pop(0)
+    finally:
+        os.close(in_fd)
+
+
+def merge_segments(ts_files: list, output_file: str):
+    """
+    Concatenate segment files into output_file with constant memory
+    Uses copy_file_range / sendfile when the platform offers them, else a bounded buffer copy
+    :param ts_files: local segment paths, in playlist order
+    :param output_file: merged file path
+    :return: (written bytes, elapsed seconds, copy method name)
+"""
+    sources = []
+    for ts_file in ts_files:
+        try:
+            sources.append((ts_file, os.stat(ts_file).st_size))
+        except FileNotFoundError:
+            print(f"[WARN] File Not Exist - {ts_file}")
+    total = sum(size for _, size in sources)
+
+    methods = copy_methods()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    written = 0
+    start = time.perf_counter()
+
+    # Merged under another name and renamed, an existing output is never left half written
+    part_file = output_file + ".part"
+    out_fd = os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        _preallocate(out_fd, total)
+        for ts_file, size in sources:
+            written += copy_segment(methods, ts_file, size, out_fd, written, buffer)
+        # A segment may have changed size since it was stat'ed, cut the preallocated tail
+        os.ftruncate(out_fd, written)
+    finally:
+        os.close(out_fd)
+    os.replace(part_file, output_file)
+
+    elapsed = time.perf_counter() - start
+    return written, elapsed, methods[0][0]
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+PREFIX = "m3u8_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+PROGRESS_INTERVAL = 0.5  # seconds between two progress line redraws on a terminal
+PROGRESS_LOG_INTERVAL = 10.0  # seconds between two progress lines when the output is a file or pipe
+EXPORT_INTERVAL = 10.0  # seconds between two metric exports while downloading
+
+
+class Histogram:
+    """Cumulative bucket counts like a Prometheus histogram, quantiles are interpolated inside a bucket"""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one process, keyed by name and labels
+    Updates are a dict lookup under a lock, cheap enough for every segment, and safe from the merge threads
+"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a pipeline stage: scrape, playlist, download, detect, merge"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, STAGE_BUCKETS, stage=name)
+
+    def counter(self, name: str, **labels):
+        with self._lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def gauge(self, name: str, **labels):
+        with self._lock:
+            return self.gauges.get(self._key(name, labels), 0)
+
+    def snapshot(self):
+        """One JSON-friendly dict of every metric"""
+        def label_text(labels):
+            return ",".join(f"{k}={v}" for k, v in labels)
+
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                "counters": {f"{name}{{{label_text(labels)}}}": value
+                             for (name, labels), value in self.counters.items()},
+                "gauges": {f"{name}{{{label_text(labels)}}}": value for (name, labels), value in self.gauges.items()},
+                "histograms": {f"{name}{{{label_text(labels)}}}": {
+                    "count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                    for (name, labels), h in self.histograms.items()},
+            }
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        def label_text(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+            typed = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {PREFIX}{name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, n in zip((*h.buckets, "+Inf"), h.counts):
+                    cumulative += n
+                    lines.append(f"{PREFIX}{name}_bucket{label_text(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {h.sum}")
+                lines.append(f"{PREFIX}{name}_count{label_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """'.prom' files are rewritten with the Prometheus text format, anything else gets one JSON line appended"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".prom"):
+            # replaced atomically, a collector reading the file never sees half of it
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(self.to_prometheus())
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.snapshot(), ensure_ascii=False) + "\n")
+
+
+metrics = Metrics()  # the process wide registry
+
+
+def progress_text(m: Metrics = metrics, elapsed: float = None):
+    done = m.counter("segments_total", result="ok")
+    failed = m.counter("segments_total", result="failed")
+    mb = m.counter("segment_bytes_total") / 1024 / 1024
+    rate = f" | {mb / elapsed:.1f} MB/s" if elapsed else ""
+    hedges = int(m.counter("hedges_total"))
+    hedged = (f" | {hedges} hedged, {int(m.counter('hedge_wins_total'))} won, "
+              f"~{m.counter('hedge_saved_seconds_total'):.1f}s saved") if hedges else ""
+    return (f"[PROGRESS] {done} segments, {failed} failed | {mb:.1f} MB{rate} | "
+            f"{int(m.gauge('requests_in_flight'))} in flight | {int(m.counter('segment_retries_total'))} retries"
+            f"{hedged}")
+
+
+async def report_progress(export_path: str | None = None, m: Metrics = metrics):
+    """
+    Redraw one progress line at a fixed rate instead of printing every segment, and export the metrics now and then
+    Run it as a task next to the downloads and cancel it when they finish
+"""
+    tty = sys.stdout.isatty()
+    interval = PROGRESS_INTERVAL if tty else PROGRESS_LOG_INTERVAL
+    started = time.monotonic()
+    last_export = started
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            text = progress_text(m, now - started)
+            if tty:
+                sys.stdout.write("\r" + text + "\033[K")
+                sys.stdout.flush()
+            else:
+                print(text)
+            if export_path and now - last_export >= EXPORT_INTERVAL:
+                await asyncio.to_thread(m.export, export_path)
+                last_export = now
+    finally:
+        if tty:
+            sys.stdout.write("\n")
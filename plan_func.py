@@ -0,0 +1,58 @@
+import os
+from collections import Counter
+from urllib.parse import urlparse
+
+from ad_filter_func import ads_detect_analyze_ts_pattern, ads_detect_by_sequence, ads_detect_by_duration, \
+    ads_detect_by_discontinuity, ads_detect_by_url_prefix, ads_detect_by_sizes
+
+MIN_SIGNALS = 2  # playlist detectors which must agree before a segment is held back
+MAX_DEFERRED_RATIO = 0.3  # more suspects than this means the detectors misread the playlist, defer nothing
+
+
+def plan_download(table, head_url: str = ""):
+    """
+    Predict the AD segments from the playlist alone, before anything is downloaded
+    :return: indices to defer, they are fetched only if the size check after the download says they are content
+"""
+    signals = Counter()
+    main_pattern, _ = ads_detect_analyze_ts_pattern(table.uris)
+    if main_pattern == 'sequential':
+        signals.update(ads_detect_by_sequence(table.uris))
+    signals.update(ads_detect_by_duration(table))
+    signals.update(ads_detect_by_discontinuity(table))
+    signals.update(ads_detect_by_url_prefix(table.uris, head_url))
+
+    deferred = {i for i, count in signals.items() if count >= MIN_SIGNALS}
+    if len(deferred) > len(table) * MAX_DEFERRED_RATIO:
+        print(f"[WARN] {len(deferred)} Suspected AD Segments Is Too Many, Downloading All")
+        return set()
+    if deferred:
+        seconds = sum(table.durations[i] for i in deferred if table.durations[i] >= 0)
+        print(f"[INFO] Download Plan: {len(deferred)} Suspected AD Segment(s) Deferred ({seconds:.0f}s)")
+    return deferred
+
+
+def confirm_deferred(table, deferred, ts_dir: str, probed: dict, written: dict | None = None):
+    """
+    Run the size check over the downloaded segments and the probed sizes of the deferred ones
+    :param probed: {index: Content-Length} of the deferred segments, None when the server didn't tell
+    :param written: {index: size} of the downloaded segments when they are not files in ts_dir (direct output)
+    :return: (confirmed AD indices, indices which have to be downloaded after all)
+"""
+    sizes = []
+    for i, entry in enumerate(table.uris):
+        if i in deferred:
+            size = probed.get(i)
+        elif written is not None:
+            size = written.get(i)
+        else:
+            try:
+                size = os.path.getsize(os.path.join(ts_dir, os.path.basename(urlparse(entry).path)))
+            except OSError:
+                size = None
+        if size is not None:
+            sizes.append((i, size))
+
+    flagged = set(ads_detect_by_sizes(sizes))
+    confirmed = {i for i in deferred if probed.get(i) is not None and i in flagged}
+    return confirmed, sorted(deferred - confirmed)
@@ -0,0 +1,241 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import state_store
+from ad_filter_func import ads_detect_analyze_ts_pattern, ads_detect_by_sequence, ads_detect_by_duration, \
+    ads_detect_by_filesize, ads_detect_by_sizes, ads_detect_by_packets
+from ad_fingerprint_func import known_ads_by_url, known_ads_by_content, remember_ads
+from m3u8_func import load_segment_table, segment_path
+from merge_func import merge_segments
+from metrics_func import metrics, STAGE_BUCKETS
+from stream_merge_func import finish_streamed
+from direct_output_func import compact_output
+
+# AD detection and merging are CPU and disk heavy, they run in worker processes so the download loop never waits
+POSTPROCESS_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+_pool = None
+
+
+def detect_ad_segments(table, ts_dir="./m3u8", head_url=None, planned_ads=None, sizes=None, located=None):
+    """
+    Pick the AD segments of a downloaded episode: fingerprints of confirmed ADs, the download plan's verdict and the
+    heuristics chosen by the naming pattern
+    :param sizes: (index, size) pairs already known from the streaming merge, the files are stat'ed when None
+    :param located: {index: (path, offset, size)} when the segments were written into the direct output
+    :return: set of playlist indices
+"""
+    ts_list = table.uris
+    # ADs confirmed in earlier episodes are dropped without any heuristic
+    if head_url is None:
+        playlist = state_store.get_playlist(ts_dir)
+        head_url = playlist[0] if playlist else None
+    known_ads = known_ads_by_url(head_url, table) | known_ads_by_content(table, ts_dir, located)
+    if known_ads:
+        print(f"[INFO] Known AD Segments (Fingerprint): {len(known_ads)}")
+    # ADs confirmed by the download plan were never fetched
+    if planned_ads:
+        known_ads |= set(planned_ads)
+        print(f"[INFO] Planned AD Segments (Playlist + Size): {len(planned_ads)}")
+
+    # analyze the naming patterns
+    main_pattern, patterns = ads_detect_analyze_ts_pattern(ts_list)
+    print(f"[DBG] Naming Pattern Analysis: {patterns}")
+    print(f"[DBG] Main Pattern: {main_pattern}")
+
+    ad_indices = set()
+    # according to the naming patterns to choice the analysis strategies
+    if main_pattern == 'sequential':
+        # Continuous number naming: using the sequence analysis
+        print("[INFO] Using Sequence-Based AD Detection...")
+        ad_indices = set(ads_detect_by_sequence(ts_list))
+
+    elif main_pattern == 'md5_hash':
+        # MD5-hash naming：using the duration analysis + file size analysis
+        print("[INFO] Detected MD5-Hash Naming, Using Multi-Strategy Detection...")
+
+        # Strategy1: duration analysis
+        try:
+            duration_ads = set(ads_detect_by_duration(table))
+            print(f"[DBG] Duration-Based Detection: {len(duration_ads)} suspicious segments")
+        except Exception as e:
+            print(f"[WARN] Duration Analysis Failed: {e}")
+            duration_ads = set()
+
+        # Strategy2: Analyze file size, the streaming merger already knows the sizes
+        try:
+            if sizes is not None:
+                size_ads = set(ads_detect_by_sizes(sizes))
+            else:
+                size_ads = set(ads_detect_by_filesize(ts_list, ts_dir))
+            print(f"[DBG] Size-Based Detection: {len(size_ads)} suspicious segments")
+        except Exception as e:
+            print(f"[WARN] Size Analysis Failed: {e}")
+            size_ads = set()
+        # Strategy3: MPEG-TS packet analysis (stream layout and spliced timelines), needs numpy
+        try:
+            from ts_packet_func import analyze_ts_files
+            if located is not None:
+                features = analyze_ts_files([located.get(i) for i in range(len(ts_list))])
+            else:
+                features = analyze_ts_files([segment_path(ts_dir, entry) for entry in ts_list])
+            packet_ads = set(ads_detect_by_packets(features))
+            print(f"[DBG] Packet-Based Detection: {len(packet_ads)} suspicious segments")
+        except Exception as e:
+            print(f"[WARN] Packet Analysis Failed: {e}")
+            packet_ads = set()
+        # Take the intersection (both methods consider labeling as AD), a packet verdict needs one of them to agree
+        ad_indices = (duration_ads & size_ads) | (packet_ads & (duration_ads | size_ads))
+        print(f"[INFO] Confirmed AD Segments (Intersection + Corroborated Packet): {len(ad_indices)}")
+        # If there is no intersection, it means the analysis not unreliable and no segments will be deleted
+        if not ad_indices and not known_ads:
+            print("[INFO] No Reliable AD Detection, Keeping All Segments")
+
+    else:
+        # other states: conservative strategy, not delete
+        print("[INFO] Mixed/Unknown Naming Pattern, Skipping AD Detection")
+        ad_indices = set()
+    ad_indices |= known_ads
+    return ad_indices
+
+
+def merge_m3u8(m3u8_path, output_file, auto_detect=True, manual_review=False, ts_dir="./m3u8", head_url=None,
+               planned_ads=None, streamed: dict | None = None, direct: dict | None = None):
+    """
+    Detect the ADs of a downloaded episode and merge the rest, runs in a post-processing worker process
+    :param streamed: StreamingMerger.detach() when the output was written while downloading
+    :param direct: DirectOutput.detach() when the segments were written into the output, it is compacted then
+    :return: {"ads", "written", "detect_seconds", "merge_seconds"} for the caller's metrics
+    :raises: the merge's error, the episode has no valid output then and is not done
+"""
+    summary = {"ads": 0, "written": 0, "detect_seconds": 0.0, "merge_seconds": 0.0}
+    ad_list = []
+    filtering = auto_detect
+
+    # Read m3u8 File
+    table = load_segment_table(m3u8_path)
+    ts_list = table.uris
+
+    print(f"M3U8 File Contains {len(ts_list)} Fragment(s)")
+
+    sizes = streamed and streamed["sizes"]
+    located = None
+    if direct is not None:
+        located = {i: (output_file, offset, size) for i, (offset, size) in direct["segments"].items()}
+        sizes = sorted((i, size) for i, (_, size) in direct["segments"].items())
+
+    if not auto_detect:
+        # don't auto analyze, merge file directly.
+        print("[INFO] Auto-Detection Disabled, Merging All Segments...")
+        kept = list(range(len(ts_list)))
+    else:
+        if head_url is None:
+            playlist = state_store.get_playlist(ts_dir)
+            head_url = playlist[0] if playlist else None
+        started = time.perf_counter()
+        ad_indices = detect_ad_segments(table, ts_dir, head_url, planned_ads, sizes, located)
+        summary["detect_seconds"] = time.perf_counter() - started
+        # Build a filtered list
+        kept = []
+        for i, entry in enumerate(ts_list):
+            if i in ad_indices:
+                ad_list.append(os.path.basename(entry))
+            else:
+                kept.append(i)
+
+    summary["ads"] = len(ad_list)
+    if ad_list:
+        print(f"\n[INFO] Identified {len(ad_list)} AD Segment(s) (Will Be Filtered):")
+        # Only show the first 20 to avoid flooding the screen
+        for ad in ad_list[:20]:
+            print(f"  - {ad}")
+        if len(ad_list) > 20:
+            print(f"  ... and {len(ad_list) - 20} more")
+
+        # if it needs the manual confirmation
+        if manual_review:
+            response = input("\n[?] Proceed with filtering? (y/n, default=y): ").strip().lower()
+            if response == 'n':
+                print("[INFO] Filtering Cancelled, Merging All Segments...")
+                kept = list(range(len(ts_list)))
+                filtering = False
+
+        if filtering:
+            # Remember them, later episodes skip the same ADs before downloading
+            remember_ads(head_url, table, ad_indices, ts_dir, located)
+    else:
+        print("[INFO] No AD Segments Detected")
+
+    print(f"\n[INFO] Will Merge {len(kept)} Segment(s)...")
+    filtered_list = [segment_path(ts_dir, ts_list[i]) for i in kept]
+
+    # Merge ts Files
+    try:
+        if direct is not None:
+            # The segments are in the output already, only the AD holes and the tail are left to close
+            written, elapsed, method = compact_output(output_file, direct["segments"], kept)
+            summary.update(written=written, merge_seconds=elapsed)
+            print(f"\n[SUCCESS] Output File: {os.path.abspath(output_file)}")
+            print(f"[INFO] File Size: {written / 1024 / 1024:.2f} MB")
+            print(f"[INFO] Compaction Finished in {elapsed:.2f}s ({method})")
+            return summary
+        # Most of the output was written while downloading, unless the final list disagrees with it
+        result = finish_streamed(output_file, streamed, filtered_list) if streamed is not None else None
+        if result is not None:
+            written, elapsed, method = result
+            summary.update(written=written, merge_seconds=elapsed)
+            print(f"\n[SUCCESS] Output File: {os.path.abspath(output_file)}")
+            print(f"[INFO] File Size: {written / 1024 / 1024:.2f} MB")
+            print(f"[INFO] Merge Finished {elapsed:.2f}s After The Download ({method}, streamed)")
+            return summary
+        if streamed is not None:
+            print("[INFO] Streamed Segments Differ From The Final List, Merging Again...")
+        written, elapsed, method = merge_segments(filtered_list, output_file)
+        summary.update(written=written, merge_seconds=elapsed)
+
+        print(f"\n[SUCCESS] Output File: {os.path.abspath(output_file)}")
+        print(f"[INFO] File Size: {written / 1024 / 1024:.2f} MB")
+        print(f"[INFO] Merge Throughput: {written / 1024 / 1024 / max(elapsed, 1e-6):.2f} MB/s "
+              f"({elapsed:.2f}s, {method})")
+
+    except Exception as e:
+        print(f"[ERR] Merge Failed: {e}")
+        raise
+    return summary
+
+
+def get_pool(workers: int | None = None):
+    """
+    The post-processing process pool, created on first use and shared by every episode of the run
+    Workers are spawned, not forked: a fork would copy the parent's SQLite connections and event loop threads
+"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers or POSTPROCESS_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+async def postprocess_episode(m3u8_path: str, output_file: str, ts_dir: str, head_url: str = None,
+                              planned_ads=None, streamed: dict | None = None, direct: dict | None = None):
+    """
+    Run merge_m3u8 in the process pool, several episodes merge in parallel while the downloads go on
+    :return: merge_m3u8's summary, once the worker reports back, raises when the merge failed
+"""
+    loop = asyncio.get_running_loop()
+    job = partial(merge_m3u8, m3u8_path, output_file, ts_dir=ts_dir, head_url=head_url,
+                  planned_ads=set(planned_ads or ()), streamed=streamed, direct=direct)
+    summary = await loop.run_in_executor(get_pool(), job)
+    # The worker has its own metrics registry, its timings are recorded here
+    metrics.observe("stage_seconds", summary["detect_seconds"], STAGE_BUCKETS, stage="detect")
+    metrics.observe("stage_seconds", summary["merge_seconds"], STAGE_BUCKETS, stage="merge")
+    metrics.inc("merge_bytes_total", summary["written"])
+    metrics.inc("ad_segments_total", summary["ads"])
+    return summary
+
@@ -0,0 +1,46 @@
+import asyncio
+import random
+
+import aiohttp
+
+SEGMENT_RETRIES = 5  # attempts per segment after the first one
+BACKOFF_BASE = 0.5  # seconds, doubled on every attempt
+BACKOFF_CAP = 30.0
+RETRY_BUDGET_BASE = 20  # retries every episode may spend, whatever its length
+RETRY_BUDGET_RATIO = 0.1  # plus one retry for every 10 segments requested
+
+
+class RetryBudget:
+    """
+    Retries allowed for one episode, so a broken host fails the episode quickly
+    instead of every segment burning all of its attempts
+    """
+
+    def __init__(self, base: int = RETRY_BUDGET_BASE, ratio: float = RETRY_BUDGET_RATIO):
+        self.base = base
+        self.ratio = ratio
+        self.requests = 0
+        self.used = 0
+
+    def on_request(self):
+        self.requests += 1
+
+    def take(self):
+        """Spend one retry, False when the budget is exhausted"""
+        if self.used >= self.base + self.ratio * self.requests:
+            return False
+        self.used += 1
+        return True
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP):
+    """Exponential backoff with full jitter, retries of many segments don't hit the host at the same moment"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def is_retryable_error(e: BaseException):
+    """Timeouts, broken connections, short bodies and 408/416/429/5xx are worth another try, other 4xx are not"""
+    status = getattr(e, "status", None)
+    if status is not None:
+        return status in (408, 416, 429) or status >= 500
+    return isinstance(e, (asyncio.TimeoutError, OSError, aiohttp.ClientError))
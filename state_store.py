@@ -0,0 +1,440 @@
+import os
+import sqlite3
+import threading
+import time
+
+DB_PATH = "./m3u8/state.db"
+LEGACY_ROOT = "./m3u8"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    url  TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    series_name  TEXT NOT NULL,
+    source_index INTEGER NOT NULL,  -- 1-based, same as menu_select
+    name         TEXT NOT NULL,
+    PRIMARY KEY (series_name, source_index)
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    series_name   TEXT NOT NULL,
+    source_index  INTEGER NOT NULL,
+    episode_index INTEGER NOT NULL,
+    number        TEXT NOT NULL,
+    link          TEXT NOT NULL,
+    PRIMARY KEY (series_name, source_index, episode_index)
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    episode_dir TEXT PRIMARY KEY,
+    head_url    TEXT,
+    m3u8_url    TEXT,
+    complete    INTEGER NOT NULL DEFAULT 0  -- the saved video.m3u8 ends with #EXT-X-ENDLIST
+);
+CREATE TABLE IF NOT EXISTS segments (
+    episode_dir TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    name        TEXT NOT NULL,
+    size        INTEGER,
+    checksum    TEXT,
+    mtime_ns    INTEGER,
+    completed   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (episode_dir, seq)
+);
+CREATE INDEX IF NOT EXISTS segments_name ON segments (episode_dir, name);
+CREATE TABLE IF NOT EXISTS ad_fingerprints (
+    size      INTEGER NOT NULL,
+    head_hash TEXT NOT NULL,  -- hash of the first bytes of the segment
+    url_key   TEXT NOT NULL,  -- host + path, query removed
+    duration  REAL,  -- EXTINF rounded to 0.1 s
+    PRIMARY KEY (size, head_hash, url_key)
+);
+CREATE INDEX IF NOT EXISTS ad_fingerprints_url ON ad_fingerprints (url_key, duration);
+CREATE TABLE IF NOT EXISTS ad_sightings (
+    size        INTEGER NOT NULL,
+    head_hash   TEXT NOT NULL,
+    episode_dir TEXT NOT NULL,
+    PRIMARY KEY (size, head_hash, episode_dir)
+);
+CREATE TABLE IF NOT EXISTS resolutions (
+    page_url   TEXT PRIMARY KEY,  -- episode page
+    master_url TEXT NOT NULL,
+    media_url  TEXT NOT NULL,  -- the chosen variant
+    resolved   REAL NOT NULL  -- time.time() of the lookup, the links may carry expiring tokens
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    url      TEXT NOT NULL,  -- series page
+    sources  TEXT NOT NULL DEFAULT '',  -- preferred source names, '|' separated, first match wins
+    episodes TEXT NOT NULL DEFAULT '',  -- episode ranges like '1-12,15', empty means all
+    status   TEXT NOT NULL DEFAULT 'queued',  -- queued / running / done / failed
+    error    TEXT,
+    created  REAL NOT NULL,
+    updated  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS job_episodes (
+    job_id        INTEGER NOT NULL,
+    episode_index INTEGER NOT NULL,  -- 0-based, in the order of the chosen source
+    status        TEXT NOT NULL,  -- done / failed
+    PRIMARY KEY (job_id, episode_index)
+);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+
+
+def _migrate(conn):
+    """Columns added after the first release of the store, and indices nothing reads any more"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(segments)")}
+    if "mtime_ns" not in columns:
+        conn.execute("ALTER TABLE segments ADD COLUMN mtime_ns INTEGER")
+    # the resume check reads the manifest of the episode folder, the primary key covers it
+    conn.execute("DROP INDEX IF EXISTS segments_pending")
+
+
+def _key(episode_dir: str):
+    """Episode folders are spelled with and without trailing slash, store one spelling"""
+    return os.path.normpath(episode_dir)
+
+
+def connect(db_path: str = DB_PATH):
+    """Connection of the calling thread, WAL lets the download loop and the worker threads use it together"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent without a fsync per commit
+        connections[db_path] = conn
+        with _init_lock:
+            if db_path not in _initialized:
+                with conn:
+                    conn.executescript(_SCHEMA)
+                    _migrate(conn)
+                _initialized.add(db_path)
+                import_legacy(conn, os.path.dirname(db_path) or LEGACY_ROOT)
+    return conn
+
+
+#  ======================= SERIES / SOURCES / EPISODES =======================
+def get_series_name(url: str, db_path: str = DB_PATH):
+    row = connect(db_path).execute("SELECT name FROM series WHERE url = ?", (url,)).fetchone()
+    return row[0] if row else None
+
+
+def save_series(url: str, name: str, db_path: str = DB_PATH):
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO series (url, name) VALUES (?, ?)", (url, name))
+
+
+def save_episode_list(series_name: str, sources: list, episodes: list, db_path: str = DB_PATH):
+    """
+    Replace the episode list of a series
+    :param sources: source names, in page order
+    :param episodes: one list of (number, link) per source
+"""
+    conn = connect(db_path)
+    with conn:
+        conn.execute("DELETE FROM sources WHERE series_name = ?", (series_name,))
+        conn.execute("DELETE FROM episodes WHERE series_name = ?", (series_name,))
+        conn.executemany("INSERT INTO sources (series_name, source_index, name) VALUES (?, ?, ?)",
+                         [(series_name, i, name) for i, name in enumerate(sources, 1)])
+        conn.executemany(
+            "INSERT INTO episodes (series_name, source_index, episode_index, number, link) VALUES (?, ?, ?, ?, ?)",
+            [(series_name, i, j, number, link)
+             for i, source_episodes in enumerate(episodes, 1)
+             for j, (number, link) in enumerate(source_episodes)])
+
+
+def get_sources(series_name: str, db_path: str = DB_PATH):
+    rows = connect(db_path).execute(
+        "SELECT name FROM sources WHERE series_name = ? ORDER BY source_index", (series_name,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_episodes(series_name: str, source_index: int, db_path: str = DB_PATH):
+    """:return: (episode numbers, episode links) of one source, source_index is 1-based"""
+    rows = connect(db_path).execute(
+        "SELECT number, link FROM episodes WHERE series_name = ? AND source_index = ? ORDER BY episode_index",
+        (series_name, source_index)).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+#  ======================= PLAYLISTS / SEGMENTS =======================
+def save_playlist(episode_dir: str, head_url: str = None, m3u8_url: str = None, complete: bool = None,
+                  db_path: str = DB_PATH):
+    """Insert or update the playlist of an episode, None leaves a column unchanged"""
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO playlists (episode_dir) VALUES (?)", (_key(episode_dir),))
+        for column, value in (("head_url", head_url), ("m3u8_url", m3u8_url), ("complete", complete)):
+            if value is not None:
+                conn.execute(f"UPDATE playlists SET {column} = ? WHERE episode_dir = ?",
+                             (int(value) if column == "complete" else value, _key(episode_dir)))
+
+
+def get_playlist(episode_dir: str, db_path: str = DB_PATH):
+    """:return: (head_url, m3u8_url, complete) or None"""
+    row = connect(db_path).execute("SELECT head_url, m3u8_url, complete FROM playlists WHERE episode_dir = ?",
+                                   (_key(episode_dir),)).fetchone()
+    return (row[0], row[1], bool(row[2])) if row else None
+
+
+def get_resolution(page_url: str, max_age: float, db_path: str = DB_PATH):
+    """:return: (master_url, media_url) resolved from page_url less than max_age seconds ago, or None"""
+    row = connect(db_path).execute("SELECT master_url, media_url FROM resolutions WHERE page_url = ? AND resolved > ?",
+                                   (page_url, time.time() - max_age)).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def save_resolution(page_url: str, master_url: str, media_url: str, db_path: str = DB_PATH):
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO resolutions (page_url, master_url, media_url, resolved) "
+                     "VALUES (?, ?, ?, ?)", (page_url, master_url, media_url, time.time()))
+
+
+def save_segments(episode_dir: str, names: list, db_path: str = DB_PATH):
+    """Register the segments of a freshly downloaded playlist, segment status starts over"""
+    conn = connect(db_path)
+    with conn:
+        conn.execute("DELETE FROM segments WHERE episode_dir = ?", (_key(episode_dir),))
+        conn.executemany("INSERT INTO segments (episode_dir, seq, name) VALUES (?, ?, ?)",
+                         [(_key(episode_dir), seq, name) for seq, name in enumerate(names)])
+
+
+def has_segments(episode_dir: str, db_path: str = DB_PATH):
+    row = connect(db_path).execute("SELECT 1 FROM segments WHERE episode_dir = ? LIMIT 1",
+                                   (_key(episode_dir),)).fetchone()
+    return row is not None
+
+
+def mark_segments_done(episode_dir: str, results: list, db_path: str = DB_PATH):
+    """:param results: (name, size[, checksum[, mtime_ns]]) of finished segments"""
+    conn = connect(db_path)
+    with conn:
+        conn.executemany(
+            "UPDATE segments SET completed = 1, size = ?, checksum = ?, mtime_ns = ? WHERE episode_dir = ? AND name = ?",
+            [(r[1], r[2] if len(r) > 2 else None, r[3] if len(r) > 3 else None, _key(episode_dir), r[0])
+             for r in results])
+
+
+def mark_segments_missing(episode_dir: str, names: list, db_path: str = DB_PATH):
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("UPDATE segments SET completed = 0 WHERE episode_dir = ? AND name = ?",
+                         [(_key(episode_dir), name) for name in names])
+
+
+def get_segment_manifest(episode_dir: str, db_path: str = DB_PATH):
+    """:return: {name: (size, mtime_ns, checksum)} of the completed segments"""
+    rows = connect(db_path).execute(
+        "SELECT name, size, mtime_ns, checksum FROM segments WHERE episode_dir = ? AND completed = 1",
+        (_key(episode_dir),)).fetchall()
+    return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+
+#  ======================= AD FINGERPRINTS =======================
+def save_ad_fingerprints(episode_dir: str, rows: list, db_path: str = DB_PATH):
+    """:param rows: (size, head_hash, url_key, duration) of the AD segments confirmed in episode_dir"""
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO ad_fingerprints (size, head_hash, url_key, duration) "
+                         "VALUES (?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR IGNORE INTO ad_sightings (size, head_hash, episode_dir) VALUES (?, ?, ?)",
+                         [(row[0], row[1], _key(episode_dir)) for row in rows])
+
+
+def get_ad_urls(min_episodes: int = 1, db_path: str = DB_PATH):
+    """:return: {(url_key, duration)} of the AD fingerprints seen in at least min_episodes episodes"""
+    rows = connect(db_path).execute(
+        "SELECT f.url_key, f.duration FROM ad_fingerprints f "
+        "JOIN ad_sightings s ON s.size = f.size AND s.head_hash = f.head_hash "
+        "GROUP BY f.url_key, f.duration HAVING COUNT(DISTINCT s.episode_dir) >= ?", (min_episodes,)).fetchall()
+    return {(row[0], row[1]) for row in rows}
+
+
+def get_ad_contents(db_path: str = DB_PATH):
+    """:return: {size: {head_hash}} of every AD fingerprint"""
+    contents = {}
+    for size, head_hash in connect(db_path).execute("SELECT DISTINCT size, head_hash FROM ad_fingerprints"):
+        contents.setdefault(size, set()).add(head_hash)
+    return contents
+
+
+#  ======================= JOB QUEUE =======================
+def enqueue_job(url: str, sources=(), episodes: str = "", db_path: str = DB_PATH):
+    """Queue one series for the batch worker, :return: the job id"""
+    now = time.time()
+    conn = connect(db_path)
+    with conn:
+        cursor = conn.execute("INSERT INTO jobs (url, sources, episodes, created, updated) VALUES (?, ?, ?, ?, ?)",
+                              (url, "|".join(sources), episodes, now, now))
+    return cursor.lastrowid
+
+
+def claim_job(db_path: str = DB_PATH):
+    """
+    Take the oldest unfinished job and mark it running, a job left 'running' by a stopped worker comes first
+    :return: (id, url, [source names], episode ranges) or None when the queue is empty
+"""
+    conn = connect(db_path)
+    with conn:
+        row = conn.execute("SELECT id, url, sources, episodes FROM jobs WHERE status IN ('running', 'queued') "
+                           "ORDER BY status = 'queued', id LIMIT 1").fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row[0]))
+    return row[0], row[1], [name for name in row[2].split("|") if name], row[3]
+
+
+def finish_job(job_id: int, status: str, error: str = None, db_path: str = DB_PATH):
+    conn = connect(db_path)
+    with conn:
+        conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                     (status, error, time.time(), job_id))
+
+
+def requeue_failed_jobs(db_path: str = DB_PATH):
+    """Put the failed jobs back in the queue, their finished episodes stay finished"""
+    conn = connect(db_path)
+    with conn:
+        return conn.execute("UPDATE jobs SET status = 'queued', error = NULL, updated = ? WHERE status = 'failed'",
+                            (time.time(),)).rowcount
+
+
+def list_jobs(db_path: str = DB_PATH):
+    """:return: (id, url, status, episodes done, error) of every job"""
+    return connect(db_path).execute(
+        "SELECT j.id, j.url, j.status, "
+        "(SELECT COUNT(*) FROM job_episodes e WHERE e.job_id = j.id AND e.status = 'done'), j.error "
+        "FROM jobs j ORDER BY j.id").fetchall()
+
+
+def mark_job_episodes(job_id: int, results: list, db_path: str = DB_PATH):
+    """:param results: (episode_index, 'done' | 'failed') rows"""
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO job_episodes (job_id, episode_index, status) VALUES (?, ?, ?)",
+                         [(job_id, index, status) for index, status in results])
+
+
+def get_done_job_episodes(job_id: int, db_path: str = DB_PATH):
+    rows = connect(db_path).execute(
+        "SELECT episode_index FROM job_episodes WHERE job_id = ? AND status = 'done'", (job_id,)).fetchall()
+    return {row[0] for row in rows}
+
+
+#  ======================= LEGACY TEXT FILES =======================
+def _read_download_list(path):
+    """Parse the old downloadList.txt: '-Video-Source: -a-b', then '=== a ===' blocks of '# number' / link lines"""
+    sources, episodes = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("-Video-Source:"):
+                content = line.split(":", 1)[1].strip()
+                sources = [item.strip() for item in content.split("-") if item.strip()]
+            elif line.startswith("="):
+                episodes.append([])
+            elif episodes and line.startswith("#"):
+                episodes[-1].append([line.strip("# "), None])
+            elif episodes and episodes[-1] and episodes[-1][-1][1] is None:
+                episodes[-1][-1][1] = line
+    episodes = [[(number, link) for number, link in block if link] for block in episodes]
+    return sources, episodes
+
+
+def _read_playlist_entries(path):
+    entries, complete = [], False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line == "#EXT-X-ENDLIST":
+                complete = True
+            elif line and not line.startswith("#"):
+                entries.append(line)
+    return entries, complete
+
+
+def import_legacy(conn: sqlite3.Connection, root: str = LEGACY_ROOT):
+    """
+    One-time import of history.txt, downloadList.txt, data.txt and the finished segments of each cache folder
+    The text files are left in place, they are just not read anymore
+"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+        return
+    imported = 0
+    with conn:
+        history_path = os.path.join(root, "history.txt")
+        if os.path.exists(history_path):
+            with open(history_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    url, sep, name = line.strip().partition("=")
+                    if sep and name:
+                        conn.execute("INSERT OR REPLACE INTO series (url, name) VALUES (?, ?)", (url, name))
+                        imported += 1
+
+        for series_name in (os.listdir(root) if os.path.isdir(root) else []):
+            series_dir = os.path.join(root, series_name)
+            if not os.path.isdir(series_dir):
+                continue
+            for list_path in (os.path.join(series_dir, "downloadList.txt"),
+                              os.path.join(series_dir, "cache", "downloadList.txt")):
+                if os.path.exists(list_path):
+                    sources, episodes = _read_download_list(list_path)
+                    conn.execute("DELETE FROM sources WHERE series_name = ?", (series_name,))
+                    conn.execute("DELETE FROM episodes WHERE series_name = ?", (series_name,))
+                    conn.executemany("INSERT INTO sources VALUES (?, ?, ?)",
+                                     [(series_name, i, s) for i, s in enumerate(sources, 1)])
+                    conn.executemany("INSERT INTO episodes VALUES (?, ?, ?, ?, ?)",
+                                     [(series_name, i, j, number, link)
+                                      for i, block in enumerate(episodes, 1)
+                                      for j, (number, link) in enumerate(block)])
+                    imported += 1
+                    break
+
+            cache_dir = os.path.join(series_dir, "cache")
+            for episode in (os.listdir(cache_dir) if os.path.isdir(cache_dir) else []):
+                episode_dir = os.path.join(cache_dir, episode)
+                data_path = os.path.join(episode_dir, "file", "data.txt")
+                m3u8_path = os.path.join(episode_dir, "file", "video.m3u8")
+                if not os.path.exists(m3u8_path):
+                    continue
+                head_url = None
+                if os.path.exists(data_path):
+                    with open(data_path, "r", encoding="utf-8") as f:
+                        for line in f:
+                            if line.startswith("#HEAD_URL:"):
+                                head_url = line.split(":", 1)[1].strip()
+                                break
+                entries, complete = _read_playlist_entries(m3u8_path)
+                key = _key(episode_dir)
+                conn.execute("INSERT OR REPLACE INTO playlists (episode_dir, head_url, complete) VALUES (?, ?, ?)",
+                             (key, head_url, int(complete)))
+                conn.execute("DELETE FROM segments WHERE episode_dir = ?", (key,))
+                rows = []
+                for seq, name in enumerate(entries):
+                    ts_path = os.path.join(episode_dir, os.path.basename(name.split("?", 1)[0]))
+                    stat = os.stat(ts_path) if os.path.exists(ts_path) else None
+                    rows.append((key, seq, name, stat and stat.st_size, stat and stat.st_mtime_ns, int(bool(stat))))
+                conn.executemany("INSERT INTO segments (episode_dir, seq, name, size, mtime_ns, completed) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", rows)
+                imported += 1
+
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', '1')")
+    if imported:
+        print(f"[INFO] Imported {imported} Legacy Record(s) Into {root}")
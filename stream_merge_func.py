@@ -0,0 +1,228 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from ad_filter_func import ads_detect_analyze_ts_pattern, ads_detect_by_sequence, ads_detect_by_duration
+from merge_func import copy_methods, copy_segment, COPY_BUFFER_SIZE
+
+SIZE_SETTLE_RATIO = 0.5  # share of the segments seen before the running size check may drop a segment
+PART_SUFFIX = ".part"  # the output grows under this name, a finished output is only replaced by a finished one
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class RunningSizeStats:
+    """Median and mean absolute deviation of the segment sizes, updated as each segment completes"""
+
+    def __init__(self):
+        self.values = []  # kept sorted
+        self.total = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, size: int):
+        bisect.insort(self.values, size)
+        self.total += size
+
+    def is_outlier(self, size: int):
+        """Same rule as ads_detect_by_sizes: more than 3 * MAD away from the median"""
+        n = len(self.values)
+        if n < 10:
+            return False
+        median = self.values[n // 2]
+        below = n // 2
+        below_sum = sum(self.values[:below])
+        # sum |s - median| split at the median: the lower half is <= median, the upper half >= median
+        mad = (median * below - below_sum + (self.total - below_sum) - median * (n - below)) / n
+        return mad > 0 and abs(size - median) > 3 * mad
+
+
+class StreamingMerger:
+    """
+    Append the segments of an episode to the output file in playlist order while the download is still running
+    A segment is written as soon as every segment before it is written or dropped, so when the last one completes
+    the episode is almost merged. The decisions match merge_m3u8's detection, and merge_m3u8 merges from scratch
+    whenever its final segment list doesn't start with what was streamed (see detach / finish_streamed).
+    The stream goes to '<output>.part', finish_streamed renames it, an existing output survives a failed run.
+"""
+
+    def __init__(self, table, ts_dir: str, output_file: str, excluded=()):
+        self.ts_dir = ts_dir
+        self.output_file = output_file
+        self.part_file = output_file + PART_SUFFIX
+        self.paths = [os.path.join(ts_dir, os.path.basename(urlparse(entry).path)) for entry in table.uris]
+        self.index = {}
+        for i, entry in enumerate(table.uris):
+            self.index.setdefault(entry, []).append(i)
+
+        # The playlist is complete before the download, the duration and naming checks are known up front
+        pattern, _ = ads_detect_analyze_ts_pattern(table.uris)
+        self.dropped = set(excluded)
+        self.size_checked = set()
+        if pattern == 'sequential':
+            self.dropped |= set(ads_detect_by_sequence(table.uris))
+        elif pattern == 'md5_hash':
+            # an AD needs the duration and the size check to agree, only these wait for the size statistics
+            self.size_checked = set(ads_detect_by_duration(table))
+
+        self.sizes = {}
+        self.stats = RunningSizeStats()
+        self.settle = max(10, int(len(table) * SIZE_SETTLE_RATIO))
+        self.next = 0
+        self.appended = []
+        self.written = 0
+
+        self._lock = threading.Lock()  # segment state, shared by the event loop and the writer thread
+        self._write_lock = threading.Lock()  # the output file
+        self._writing = False
+        self._methods = copy_methods()
+        self._buffer = bytearray(COPY_BUFFER_SIZE)
+        self._fd = os.open(self.part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                           0o644)
+
+    def seed(self, on_disk: dict):
+        """Segments finished before this run, called on the event loop, on_disk is scan_segment_dir's result"""
+        with self._lock:
+            for i, path in enumerate(self.paths):
+                stat = on_disk.get(os.path.basename(path))
+                if stat is not None and i not in self.sizes:
+                    self.sizes[i] = stat[0]
+                    self.stats.add(stat[0])
+        self._kick()
+
+    def exclude(self, indices):
+        """Drop segments decided to be ADs while downloading (the deferred ones of the download plan)"""
+        with self._lock:
+            self.dropped |= set(indices)
+        self._kick()
+
+    def add(self, name: str, size: int):
+        """A segment finished, called on the event loop"""
+        with self._lock:
+            for i in self.index.get(name, ()):
+                if i not in self.sizes:
+                    self.sizes[i] = size
+                    self.stats.add(size)
+        self._kick()
+
+    def size_pairs(self):
+        """(index, size) of every finished segment, for the final size check without another stat pass"""
+        with self._lock:
+            return sorted(self.sizes.items())
+
+    def _ready(self):
+        """Segments which may be written now, in order, the caller holds self._lock"""
+        ready = []
+        while self.next < len(self.paths):
+            i = self.next
+            if i in self.dropped:
+                self.next += 1
+                continue
+            if i not in self.sizes:
+                break
+            if i in self.size_checked:
+                if len(self.stats) < self.settle:
+                    break  # too few sizes to trust the verdict yet
+                if self.stats.is_outlier(self.sizes[i]):
+                    self.dropped.add(i)
+                    self.next += 1
+                    continue
+            ready.append((self.paths[i], self.sizes[i]))
+            self.next += 1
+        return ready
+
+    def _kick(self):
+        with self._lock:
+            if self._writing or self._fd is None:
+                return
+            self._writing = True
+        asyncio.get_running_loop().run_in_executor(None, self._drain)
+
+    def _drain(self):
+        """Writer thread: append the contiguous prefix until nothing is ready"""
+        while True:
+            with self._lock:
+                ready = self._ready()
+                if not ready:
+                    self._writing = False
+                    return
+            with self._write_lock:
+                if self._fd is None:
+                    return
+                try:
+                    for path, size in ready:
+                        self.written += copy_segment(self._methods, path, size, self._fd, self.written,
+                                                     self._buffer)
+                        self.appended.append(path)
+                except OSError as e:
+                    # finish() sees the closed output and merge_m3u8 merges from scratch
+                    print(f"[WARN] Streaming Merge Stopped: {e}")
+                    os.close(self._fd)
+                    self._fd = None
+                    return
+
+    def detach(self):
+        """
+        Stop streaming and hand over what was written, the rest is appended by finish_streamed, in any process
+        :return: {"path": the part file, "appended": paths written in order, "written": bytes,
+          "sizes": (index, size) pairs}, or None when streaming broke off and the output must be merged from scratch
+"""
+        with self._write_lock:
+            if self._fd is None:
+                _remove(self.part_file)
+                return None
+            os.close(self._fd)
+            self._fd = None
+            return {"path": self.part_file, "appended": list(self.appended), "written": self.written,
+                    "sizes": self.size_pairs()}
+
+    def close(self):
+        """Give up streaming, the part file is removed and an output of an earlier run stays as it was"""
+        with self._write_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            _remove(self.part_file)
+
+
+def finish_streamed(output_file: str, streamed: dict, ts_files: list):
+    """
+    Append the rest of the final segment list to a streamed output and move it to output_file
+    :param streamed: StreamingMerger.detach()
+    :return: (written bytes, elapsed seconds of this call, copy method), or None when the streamed prefix is not
+      the start of ts_files, the part file is removed and the output must be merged again then
+"""
+    start = time.perf_counter()
+    appended = streamed["appended"]
+    if ts_files[:len(appended)] != appended:
+        _remove(streamed["path"])
+        return None
+    print(f"[INFO] Streaming Merge: {len(appended)} Segment(s) Already Written, "
+          f"Appending {len(ts_files) - len(appended)}")
+
+    methods = copy_methods()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    written = streamed["written"]
+    fd = os.open(streamed["path"], os.O_WRONLY | getattr(os, "O_BINARY", 0))
+    try:
+        for path in ts_files[len(appended):]:
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                print(f"[WARN] File Not Exist - {path}")
+                continue
+            written += copy_segment(methods, path, size, fd, written, buffer)
+        os.ftruncate(fd, written)
+    finally:
+        os.close(fd)
+    os.replace(streamed["path"], output_file)  # atomic, like the segment .part files
+    return written, time.perf_counter() - start, methods[0][0]
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PTS_CLOCK = 90000  # PTS/PCR base ticks per second
+PTS_WRAP = 1 << 33
+NULL_PID = 0x1FFF
+FIRST_STREAM_PID = 0x20  # 0x00-0x1F are PAT, CAT, NIT, SDT, EIT and other tables a muxer adds now and then
+ANALYZE_WORKERS = 4  # mmap reads overlap across files, numpy releases the GIL in the heavy parts
+
+
+def _pts_diff(a, b):
+    """b - a in 90 kHz ticks, across the 33-bit wrap"""
+    return ((b - a + PTS_WRAP // 2) % PTS_WRAP) - PTS_WRAP // 2
+
+
+def analyze_ts_file(path: str, offset: int = 0, size: int | None = None):
+    """
+    Packet level features of one segment, the file is memory-mapped and read as an (n, 188) uint8 array
+    offset / size select a segment written inside a bigger file (the direct output), the whole file by default
+    :return: dict, or None when the file is not MPEG-TS
+      - packets, sync_ratio: packet count and share of packets starting with 0x47
+      - pids: sorted tuple of the stream PIDs, different muxers (ads) usually number their streams differently,
+        null packets (CBR stuffing) and the PSI/SI PIDs are left out, they come and go inside one stream
+      - video_pid: PID carrying the video PES (stream id 0xE0-0xEF)
+      - cc_errors: continuity counter breaks, without the ones announced by a discontinuity indicator
+      - discontinuities: packets with the adaptation field discontinuity indicator
+      - pts_start / pts_end: first and last video PTS (90 kHz)
+      - pcr_start / pcr_end: first and last PCR base
+      - video_bitrate: video PES bytes per second of PTS, a resolution / encoder change moves it a lot
+"""
+    if size is None:
+        size = os.path.getsize(path) - offset
+    if size < TS_PACKET_SIZE:
+        return None
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=(size,))
+    n = len(data) // TS_PACKET_SIZE
+    pk = data[:n * TS_PACKET_SIZE].reshape(n, TS_PACKET_SIZE)
+
+    sync = pk[:, 0] == SYNC_BYTE
+    sync_ratio = float(sync.mean())
+    if sync_ratio < 0.9:
+        return None
+    if not sync.all():
+        pk = pk[sync]  # copies, only for damaged files
+
+    b1 = pk[:, 1].astype(np.uint16)
+    pid = ((b1 & 0x1F) << 8) | pk[:, 2]
+    pusi = (b1 & 0x40) != 0
+    afc = (pk[:, 3] >> 4) & 0x3
+    cc = (pk[:, 3] & 0x0F).astype(np.int16)
+    has_payload = (afc & 1) != 0
+    has_af = (afc & 2) != 0
+    af_len = np.where(has_af, pk[:, 4], 0).astype(np.int32)
+    af_flags = np.where(has_af & (af_len > 0), pk[:, 5], 0)
+    discontinuity = (af_flags & 0x80) != 0
+
+    # Continuity counters: per PID, payload packets count up by one (mod 16), a repeated value is a duplicate
+    rows = np.flatnonzero(has_payload & (pid != NULL_PID))
+    order = rows[np.argsort(pid[rows], kind="stable")]
+    same_pid = pid[order][1:] == pid[order][:-1]
+    step = (cc[order][1:] - cc[order][:-1]) % 16
+    broken = same_pid & (step != 1) & (step != 0) & ~discontinuity[order][1:]
+    cc_errors = int(broken.sum())
+
+    # PCR base: 33 bits after the adaptation field flags
+    pcr_rows = np.flatnonzero(((af_flags & 0x10) != 0) & (af_len >= 7))
+    pcr_start = pcr_end = None
+    if len(pcr_rows):
+        b = pk[pcr_rows, 6:11].astype(np.int64)
+        pcr = (b[:, 0] << 25) | (b[:, 1] << 17) | (b[:, 2] << 9) | (b[:, 3] << 1) | (b[:, 4] >> 7)
+        pcr_start, pcr_end = int(pcr[0]), int(pcr[-1])
+
+    # PES headers start right after the adaptation field of the payload unit start packets
+    start_rows = np.flatnonzero(pusi & has_payload)
+    offset = 4 + np.where(has_af[start_rows], 1 + af_len[start_rows], 0)
+    fits = offset + 14 <= TS_PACKET_SIZE
+    start_rows, offset = start_rows[fits], offset[fits]
+    head = pk[start_rows[:, None], offset[:, None] + np.arange(14)].astype(np.int64)
+    is_pes = (head[:, 0] == 0) & (head[:, 1] == 0) & (head[:, 2] == 1)
+    is_video = is_pes & (head[:, 3] >= 0xE0) & (head[:, 3] <= 0xEF)
+
+    video_pid = None
+    pts_start = pts_end = None
+    video_bitrate = None
+    if is_video.any():
+        video_pids, counts = np.unique(pid[start_rows[is_video]], return_counts=True)
+        video_pid = int(video_pids[np.argmax(counts)])
+        with_pts = is_video & (pid[start_rows] == video_pid) & ((head[:, 7] & 0x80) != 0)
+        if with_pts.any():
+            h = head[with_pts]
+            pts = (((h[:, 9] >> 1) & 0x7) << 30) | (h[:, 10] << 22) | ((h[:, 11] >> 1) << 15) \
+                | (h[:, 12] << 7) | (h[:, 13] >> 1)
+            # B-frames make PTS non monotonic inside a segment, the span is min..max
+            pts_start, pts_end = int(pts.min()), int(pts.max())
+            span = _pts_diff(pts_start, pts_end) / PTS_CLOCK
+            if span > 0:
+                video_bytes = int((pid == video_pid).sum()) * TS_PACKET_SIZE
+                video_bitrate = video_bytes * 8 / span
+
+    return {
+        "packets": int(n),
+        "sync_ratio": sync_ratio,
+        "pids": tuple(int(p) for p in np.unique(pid) if FIRST_STREAM_PID <= p != NULL_PID),
+        "video_pid": video_pid,
+        "cc_errors": cc_errors,
+        "discontinuities": int(discontinuity.sum()),
+        "pts_start": pts_start,
+        "pts_end": pts_end,
+        "pcr_start": pcr_start,
+        "pcr_end": pcr_end,
+        "video_bitrate": video_bitrate,
+    }
+
+
+def analyze_ts_files(paths: list, workers: int = ANALYZE_WORKERS):
+    """
+    analyze_ts_file over many segments, None for the missing or unreadable ones
+    :param paths: segment paths, or (path, offset, size) of the segments inside one file, None for a missing one
+"""
+    def safe_analyze(path):
+        try:
+            if path is None:
+                return None
+            return analyze_ts_file(*path) if isinstance(path, tuple) else analyze_ts_file(path)
+        except (OSError, ValueError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(safe_analyze, paths))
@@ -0,0 +1,101 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+CHECKSUM_WORKERS = min(8, (os.cpu_count() or 2) * 2)  # hashing is disk bound, a few threads keep the disk busy
+
+
+def scan_segment_dir(episode_dir: str):
+    """List the finished segments of an episode with one directory scan: {file name: (size, mtime_ns)}"""
+    found = {}
+    try:
+        with os.scandir(episode_dir) as it:
+            for entry in it:
+                # .part files are unfinished downloads, never count them
+                if entry.name.endswith(".part") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return found
+
+
+def file_checksum(path: str):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def finished_rows(episode_dir: str, results: list, full: bool = False):
+    """
+    Manifest rows of just finished segments, what verify_segments compares a later run with
+    :param results: (name, size) of the finished segments
+    :param full: compute their checksums as well, so a full verification has something to compare with
+    :return: (name, size, checksum, mtime_ns) rows
+"""
+    paths = [os.path.join(episode_dir, os.path.basename(urlparse(name).path)) for name, _ in results]
+    checksums = [None] * len(paths)
+    if full and paths:
+        with ThreadPoolExecutor(max_workers=CHECKSUM_WORKERS) as pool:
+            checksums = list(pool.map(file_checksum, paths))
+    return [(name, size, checksum, os.stat(path).st_mtime_ns)
+            for (name, size), path, checksum in zip(results, paths, checksums)]
+
+
+def _discard(episode_dir, file_name, missing, name):
+    """A damaged segment is removed, else a later scan would adopt it as finished"""
+    try:
+        os.remove(os.path.join(episode_dir, file_name))
+    except OSError as e:
+        print(f"[WARN] Damaged Segment Not Removed: {file_name} {e}")
+    missing.append(name)
+
+
+def verify_segments(episode_dir: str, names: list, manifest: dict, full: bool = False):
+    """
+    Compare the episode folder with the manifest of the finished segments
+    quick mode: a segment is good when its file exists with the recorded size and mtime
+    full mode: the checksum of every existing file is computed in a thread pool and compared as well
+    :param names: playlist entries of the episode, in order
+    :param manifest: {name: (size, mtime_ns, checksum)} recorded when the segments finished
+    :return: (missing or damaged names, (name, size, checksum, mtime_ns) rows to record), damaged files are removed
+"""
+    on_disk = scan_segment_dir(episode_dir)
+    missing = []
+    present = []
+    for name in names:
+        file_name = os.path.basename(urlparse(name).path)
+        stat = on_disk.get(file_name)
+        if stat is None:
+            missing.append(name)
+            continue
+        expected = manifest.get(name)
+        if expected is not None and expected[0] is not None and expected[0] != stat[0]:
+            _discard(episode_dir, file_name, missing, name)  # short or overwritten file
+        elif not full and expected is not None and expected[1] is not None and expected[1] != stat[1]:
+            _discard(episode_dir, file_name, missing, name)  # changed since it was downloaded, can't tell how
+        else:
+            present.append((name, file_name, stat))
+
+    if not full:
+        # Files without a manifest entry were finished by the atomic rename, adopt them
+        record = [(name, stat[0], None, stat[1]) for name, _, stat in present if name not in manifest]
+        return missing, record
+
+    paths = [os.path.join(episode_dir, file_name) for _, file_name, _ in present]
+    with ThreadPoolExecutor(max_workers=CHECKSUM_WORKERS) as pool:
+        checksums = list(pool.map(file_checksum, paths))
+
+    record = []
+    for (name, file_name, stat), checksum in zip(present, checksums):
+        expected = manifest.get(name)
+        if expected is not None and expected[2] is not None and expected[2] != checksum:
+            _discard(episode_dir, file_name, missing, name)
+        else:
+            record.append((name, stat[0], checksum, stat[1]))
+    return missing, record